@@ -1,20 +1,36 @@
 import os
 import json
-import requests
+import asyncio
+import re
+import time
+import queue
+import secrets
+import threading
 import traceback
+import httpx
+import msgspec
+import tiktoken
+from collections import OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from cachelib import FileSystemCache
 from dotenv import load_dotenv
-from flask import Flask, render_template, redirect, url_for, session, request, jsonify, Response, flash
+from flask import Flask, Request, render_template, redirect, url_for, session, request, jsonify, Response, flash, make_response
 from authlib.integrations.flask_client import OAuth
 from supabase import create_client, Client
 from functools import wraps
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 import base64
+import hashlib
 import io
-from PIL import Image
+import tempfile
+from PIL import Image, ImageOps
 from werkzeug.utils import secure_filename
+from werkzeug.test import EnvironBuilder
+from asgiref.wsgi import WsgiToAsgi
 import mimetypes
 from openai import OpenAI
-from groq import Groq # <-- ADDED: Import Groq
+from groq import AsyncGroq
 
 # Load environment variables from .env file
 load_dotenv()
@@ -32,11 +48,98 @@ openrouter_client = OpenAI(
   api_key=os.getenv("OPENROUTER_API_KEY"),
 )
 
-# --- ADDED: Groq Client Initialization ---
-groq_client = Groq(
-    api_key=os.getenv("GROQ_API_KEY"),
-)
-# ----------------------------------------
+OPENROUTER_CHAT_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# --- Upstream Connection Pool ---
+# Every upstream caller (OpenRouter, Groq, LangSearch) shares one keep-alive
+# pool per event loop. The WSGI route runs everything on a single background
+# loop and ASGI workers have one loop each, so in practice it is one pool per process.
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "200"))
+UPSTREAM_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_KEEPALIVE_CONNECTIONS", "50"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "True") == "True"
+
+
+class UpstreamPoolMetrics:
+    """Per-host counters for connections opened/reused and time spent waiting on the pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, host, opened, wait_seconds):
+        with self._lock:
+            stats = self._hosts.setdefault(host, {
+                'requests': 0, 'connections_opened': 0, 'connections_reused': 0,
+                'pool_wait_ms_total': 0.0, 'pool_wait_ms_max': 0.0,
+            })
+            stats['requests'] += 1
+            stats['connections_opened' if opened else 'connections_reused'] += 1
+            wait_ms = wait_seconds * 1000
+            stats['pool_wait_ms_total'] += wait_ms
+            stats['pool_wait_ms_max'] = max(stats['pool_wait_ms_max'], wait_ms)
+
+    def snapshot(self):
+        with self._lock:
+            hosts = {host: dict(stats) for host, stats in self._hosts.items()}
+        for stats in hosts.values():
+            stats['pool_wait_ms_avg'] = stats['pool_wait_ms_total'] / stats['requests']
+        return {
+            'pool_size': UPSTREAM_POOL_SIZE,
+            'keepalive_connections': UPSTREAM_KEEPALIVE_CONNECTIONS,
+            'http2': UPSTREAM_HTTP2,
+            'hosts': hosts,
+        }
+
+
+upstream_pool_metrics = UpstreamPoolMetrics()
+_loop_clients = {}
+
+
+async def trace_upstream_request(request):
+    """httpx request hook: times how long the request waits for a pooled connection."""
+    started = time.perf_counter()
+    host = request.url.host
+    acquired = False
+
+    async def trace(event_name, info):
+        nonlocal acquired
+        if acquired:
+            return
+        # The first of these events marks the moment the pool handed us a connection
+        if event_name == "connection.connect_tcp.started":
+            opened = True
+        elif event_name.endswith("send_request_headers.started"):
+            opened = False
+        else:
+            return
+        acquired = True
+        upstream_pool_metrics.record(host, opened, time.perf_counter() - started)
+
+    request.extensions['trace'] = trace
+
+
+def get_async_clients():
+    """Returns the pooled upstream clients bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.get(loop)
+    if clients is None:
+        http_client = httpx.AsyncClient(
+            http2=UPSTREAM_HTTP2,
+            timeout=httpx.Timeout(90.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_POOL_SIZE,
+                max_keepalive_connections=UPSTREAM_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={'request': [trace_upstream_request]},
+        )
+        clients = {
+            'http': http_client,
+            'groq': AsyncGroq(api_key=os.getenv("GROQ_API_KEY"), http_client=http_client),
+        }
+        _loop_clients[loop] = clients
+    return clients
 
 # --- Supabase & OAuth Initialization ---
 supabase_url: str | None = os.getenv("SUPABASE_URL")
@@ -131,92 +234,327 @@ def logout():
 
 
 # --- Main App Routes ---
+SIDEBAR_PAGE_SIZE = int(os.getenv("SIDEBAR_PAGE_SIZE", "30"))
+UUID_PATTERN = re.compile(r"^[0-9a-fA-F-]{36}$")
+# PostgREST timestamptz as it comes back in rows; the fraction drops trailing zeros,
+# so it can have any length (datetime.fromisoformat before 3.11 only takes 3 or 6 digits)
+TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d{1,9})?(Z|[+-]\d{2}(:?\d{2})?)?$")
+
+
+def fetch_conversation_page(user_id, cursor=None, limit=SIDEBAR_PAGE_SIZE, title_query=None):
+    """One page of the sidebar, newest first, using keyset pagination on (updated_at, id).
+
+    Returns (conversations, next_cursor); next_cursor is None on the last page.
+    """
+    query = supabase.table('conversations')\
+        .select('id, title, updated_at')\
+        .eq('user_id', user_id)
+
+    if title_query:
+        query = query.ilike('title', f"%{title_query}%")
+
+    if cursor:
+        updated_at, conv_id = cursor['updated_at'], cursor['id']
+        query = query.or_(f'updated_at.lt."{updated_at}",and(updated_at.eq."{updated_at}",id.lt.{conv_id})')
+
+    # Fetch one extra row to know whether another page exists
+    rows = query\
+        .order('updated_at', desc=True)\
+        .order('id', desc=True)\
+        .limit(limit + 1)\
+        .execute().data
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = {'updated_at': rows[-1]['updated_at'], 'id': rows[-1]['id']}
+    return rows, next_cursor
+
+
+# The first sidebar page is cached per user and served stale-while-revalidate,
+# so switching between conversations only costs the messages query.
+SIDEBAR_CACHE_FRESH_SECONDS = int(os.getenv("SIDEBAR_CACHE_FRESH_SECONDS", "30"))
+SIDEBAR_CACHE_MAX_STALE_SECONDS = int(os.getenv("SIDEBAR_CACHE_MAX_STALE_SECONDS", "600"))
+SIDEBAR_CACHE_MAX_USERS = int(os.getenv("SIDEBAR_CACHE_MAX_USERS", "5000"))
+
+
+class ConversationListLoader:
+    """Per-user cache of the first sidebar page with stale-while-revalidate and per-source timings."""
+
+    def __init__(self, fresh_seconds, max_stale_seconds, max_users):
+        self.fresh_seconds = fresh_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> {'page', 'fetched_at', 'version'}
+        self._versions = {}  # bumped on invalidate so in-flight revalidations don't restore old data
+        self._revalidating = set()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sidebar-revalidate")
+        self._timings = {}
+
+    def get(self, user_id):
+        started = time.perf_counter()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            age = time.monotonic() - entry['fetched_at'] if entry else None
+            if entry and age < self.max_stale_seconds:
+                self._entries.move_to_end(user_id)
+                stale = age >= self.fresh_seconds
+                if stale and user_id not in self._revalidating:
+                    self._revalidating.add(user_id)
+                    self._executor.submit(self._revalidate, user_id)
+                page = entry['page']
+            else:
+                page = None
+        if page is not None:
+            self._record('stale_hit' if stale else 'cache_hit', time.perf_counter() - started)
+            return page
+        return self._fetch(user_id, 'query')
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def _revalidate(self, user_id):
+        try:
+            self._fetch(user_id, 'revalidate')
+        except Exception as e:
+            print(f"Error revalidating conversations for {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._revalidating.discard(user_id)
+
+    def _fetch(self, user_id, source):
+        with self._lock:
+            version = self._versions.get(user_id, 0)
+        started = time.perf_counter()
+        page = fetch_conversation_page(user_id)
+        self._record(source, time.perf_counter() - started)
+        with self._lock:
+            if self._versions.get(user_id, 0) == version:
+                self._entries[user_id] = {'page': page, 'fetched_at': time.monotonic()}
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return page
+
+    def _record(self, source, seconds):
+        with self._lock:
+            stats = self._timings.setdefault(source, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stats['count'] += 1
+            stats['total_ms'] += seconds * 1000
+            stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {source: dict(stats) for source, stats in self._timings.items()}
+            users = len(self._entries)
+        for stats in timings.values():
+            stats['avg_ms'] = stats['total_ms'] / stats['count']
+        return {'users_cached': users, 'sources': timings}
+
+
+conversation_list_loader = ConversationListLoader(
+    SIDEBAR_CACHE_FRESH_SECONDS, SIDEBAR_CACHE_MAX_STALE_SECONDS, SIDEBAR_CACHE_MAX_USERS
+)
+
+
 @app.route('/')
 @login_required
 def index():
     user_id = session['user']['id']
     greeting = get_greeting(session['user'])
-    
-    # ✅ FIX: Add explicit limit and ordering to get all conversations
-    try:
-        # Try using RPC first
-        conversations = supabase.rpc('get_conversations_with_messages', {
-            'p_user_id': user_id
-        }).execute()
-        
-        # If RPC doesn't return enough results or fails, fallback to direct query
-        if not conversations.data or len(conversations.data) < 50:  # Arbitrary check
-            print("Using fallback query for conversations")
-            conversations_fallback = supabase.table('conversations')\
-                .select('*')\
-                .eq('user_id', user_id)\
-                .order('updated_at', desc=True)\
-                .limit(100)\
-                .execute()  # Get up to 100 conversations
-            
-            if conversations_fallback.data:
-                conversations = conversations_fallback
-    
-    except Exception as e:
-        print(f"Error fetching conversations: {e}")
-        # Ultimate fallback - direct table query
-        conversations = supabase.table('conversations')\
-            .select('*')\
-            .eq('user_id', user_id)\
-            .order('updated_at', desc=True)\
-            .limit(100)\
+
+    conversations, conversations_cursor = conversation_list_loader.get(user_id)
+
+    return render_template('index.html', user=session['user'], conversations=conversations,
+                           conversations_cursor=conversations_cursor, greeting=greeting)
+
+
+
+@app.route('/conversations')
+@login_required
+def list_conversations():
+    """JSON pages of the sidebar for lazy loading and chat search."""
+    user_id = session['user']['id']
+
+    cursor = None
+    if request.args.get('updated_at') and request.args.get('id'):
+        if not TIMESTAMP_PATTERN.match(request.args['updated_at']) or not UUID_PATTERN.match(request.args['id']):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        cursor = {'updated_at': request.args['updated_at'], 'id': request.args['id']}
+
+    limit = min(request.args.get('limit', SIDEBAR_PAGE_SIZE, type=int), 100)
+    title_query = request.args.get('q', '').strip() or None
+    if cursor is None and title_query is None and limit == SIDEBAR_PAGE_SIZE:
+        conversations, next_cursor = conversation_list_loader.get(user_id)
+    else:
+        conversations, next_cursor = fetch_conversation_page(user_id, cursor, limit, title_query)
+    return jsonify({'conversations': conversations, 'next_cursor': next_cursor})
+
+
+
+# Conversations render only their newest page of messages; older ones are paged in
+# on scroll-up and reasoning is fetched when "Show Thinking" is expanded.
+MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", "30"))
+MESSAGE_LIST_COLUMNS = 'id, sender, content, sources, image_urls, has_image, created_at'
+MESSAGE_ID_PATTERN = re.compile(r"^[0-9a-fA-F-]{1,36}$")
+
+
+def user_owns_conversation(conversation_id, user_id):
+    owner_res = supabase.table('conversations')\
+        .select('id')\
+        .eq('id', conversation_id)\
+        .eq('user_id', user_id)\
+        .execute()
+    return bool(owner_res.data)
+
+
+def fetch_message_page(conversation_id, cursor=None, limit=MESSAGES_PAGE_SIZE, timings=None):
+    """The newest page of messages older than `cursor`, keyset-paginated on (created_at, id).
+
+    Returns (messages, next_cursor, total) with messages oldest first. `total` is the
+    conversation's message count and is only computed for the first page. Per-query
+    durations in ms are written to `timings` when given.
+    """
+    started = time.perf_counter()
+    query = supabase.table('messages')\
+        .select(MESSAGE_LIST_COLUMNS, count='exact' if cursor is None else None)\
+        .eq('conversation_id', conversation_id)
+
+    if cursor:
+        created_at, message_id = cursor['created_at'], cursor['id']
+        query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{message_id})')
+
+    res = query\
+        .order('created_at', desc=True)\
+        .order('id', desc=True)\
+        .limit(limit + 1)\
+        .execute()
+    rows = res.data
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = {'created_at': rows[-1]['created_at'], 'id': rows[-1]['id']}
+    rows.reverse()
+    if timings is not None:
+        timings['messages_query'] = (time.perf_counter() - started) * 1000
+
+    # Only flag which messages have reasoning; the text itself is loaded on demand
+    started = time.perf_counter()
+    ai_ids = [row['id'] for row in rows if row['sender'] == 'ai']
+    with_reasoning = set()
+    if ai_ids:
+        reasoning_res = supabase.table('messages')\
+            .select('id')\
+            .in_('id', ai_ids)\
+            .not_.is_('reasoning', 'null')\
             .execute()
-    
-    return render_template('index.html', user=session['user'], conversations=conversations.data, greeting=greeting)
+        with_reasoning = {row['id'] for row in reasoning_res.data}
+    for row in rows:
+        row['has_reasoning'] = row['id'] in with_reasoning
+    if timings is not None:
+        timings['reasoning_flags'] = (time.perf_counter() - started) * 1000
+
+    return rows, next_cursor, res.count
+
+
+# Independent page queries run concurrently on a shared, bounded pool so page
+# latency tracks the slowest query instead of the sum.
+PAGE_QUERY_WORKERS = int(os.getenv("PAGE_QUERY_WORKERS", "8"))
+page_query_executor = ThreadPoolExecutor(max_workers=PAGE_QUERY_WORKERS, thread_name_prefix="page-query")
+
 
+def run_page_queries(**queries):
+    """Runs the given zero-arg callables concurrently. Returns (results, timings_ms) keyed by name."""
+    def timed(fn):
+        started = time.perf_counter()
+        result = fn()
+        return result, (time.perf_counter() - started) * 1000
+
+    futures = {name: page_query_executor.submit(timed, fn) for name, fn in queries.items()}
+    results, timings = {}, {}
+    for name, future in futures.items():
+        results[name], timings[name] = future.result()
+    return results, timings
+
+
+def server_timing_header(timings):
+    return ', '.join(f"{name};dur={ms:.1f}" for name, ms in timings.items())
 
 
 @app.route('/conversation/<conversation_id>')
 @login_required
 def load_conversation(conversation_id):
+    started = time.perf_counter()
     user_id = session['user']['id']
     greeting = get_greeting(session['user'])
-    
-    try:
-        # Try RPC first
-        conversations_res = supabase.rpc('get_conversations_with_messages', {
-            'p_user_id': user_id
-        }).execute()
-        
-        # Fallback if needed
-        if not conversations_res.data or len(conversations_res.data) < 50:
-            print("Using fallback query for conversations in load_conversation")
-            conversations_res = supabase.table('conversations')\
-                .select('*')\
-                .eq('user_id', user_id)\
-                .order('updated_at', desc=True)\
-                .limit(100)\
-                .execute()
-    
-    except Exception as e:
-        print(f"Error fetching conversations: {e}")
-        conversations_res = supabase.table('conversations')\
-            .select('*')\
-            .eq('user_id', user_id)\
-            .order('updated_at', desc=True)\
-            .limit(100)\
-            .execute()
-    
-    # Get messages for the specific conversation
-    messages_res = supabase.table('messages')\
-        .select('*')\
-        .eq('conversation_id', conversation_id)\
-        .order('created_at', desc=False)\
-        .execute()
-    
-    return render_template(
+
+    # Sidebar and the latest page of messages don't depend on each other
+    message_timings = {}
+    results, timings = run_page_queries(
+        conversations=lambda: conversation_list_loader.get(user_id),
+        messages=lambda: fetch_message_page(conversation_id, timings=message_timings),
+    )
+    timings.update(message_timings)
+    conversations, conversations_cursor = results['conversations']
+    messages, messages_cursor, message_count = results['messages']
+
+    response = make_response(render_template(
         'index.html',
         user=session['user'],
-        conversations=conversations_res.data,
+        conversations=conversations,
+        conversations_cursor=conversations_cursor,
         active_conversation_id=conversation_id,
-        messages=messages_res.data,
+        messages=messages,
+        messages_cursor=messages_cursor,
+        message_count=message_count or len(messages),
         greeting=greeting
-    )
+    ))
+    timings['total'] = (time.perf_counter() - started) * 1000
+    response.headers['Server-Timing'] = server_timing_header(timings)
+    return response
+
+
+@app.route('/conversation/<conversation_id>/messages')
+@login_required
+def list_messages(conversation_id):
+    """JSON pages of older messages for scroll-up loading."""
+    user_id = session['user']['id']
+    if not user_owns_conversation(conversation_id, user_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+
+    cursor = None
+    if request.args.get('created_at') and request.args.get('id'):
+        if not TIMESTAMP_PATTERN.match(request.args['created_at']) or not MESSAGE_ID_PATTERN.match(request.args['id']):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        cursor = {'created_at': request.args['created_at'], 'id': request.args['id']}
+
+    limit = min(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), 100)
+    messages, next_cursor, _ = fetch_message_page(conversation_id, cursor, limit)
+    for message in messages:
+        if message.get('image_urls'):
+            message['thumbnail_urls'] = [thumbnail_url(url) for url in message['image_urls']]
+    return jsonify({'messages': messages, 'next_cursor': next_cursor})
+
+
+@app.route('/messages/<message_id>/reasoning')
+@login_required
+def message_reasoning(message_id):
+    user_id = session['user']['id']
+    if not MESSAGE_ID_PATTERN.match(message_id):
+        return jsonify({'error': 'Message not found'}), 404
+
+    message_res = supabase.table('messages')\
+        .select('conversation_id, reasoning')\
+        .eq('id', message_id)\
+        .execute()
+    if not message_res.data or not user_owns_conversation(message_res.data[0]['conversation_id'], user_id):
+        return jsonify({'error': 'Message not found'}), 404
+    return jsonify({'reasoning': message_res.data[0].get('reasoning') or ''})
+
 
 
 
@@ -248,7 +586,101 @@ web_search_tool = {
 
 
 
-def perform_web_search(query: str):
+# --- Web Search Result Cache ---
+# Many users ask about the same trending topic within minutes, so search results
+# are cached per normalized query + freshness window. "memory" is a per-process
+# LRU; "filesystem" shares entries between gunicorn workers on the same host.
+SEARCH_CACHE_BACKEND = os.getenv("SEARCH_CACHE_BACKEND", "memory")  # memory | filesystem | none
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512"))
+SEARCH_CACHE_DIR = os.getenv("SEARCH_CACHE_DIR", "/tmp/srushti-search-cache")
+
+
+def normalize_search_query(query):
+    return " ".join(re.findall(r"\w+", (query or "").lower()))
+
+
+class SearchResultCache:
+    """TTL + LRU cache of (sources, context) web search results."""
+
+    def __init__(self, backend, ttl, max_entries):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._shared = None
+        if backend == "filesystem":
+            # cachelib prunes expired entries first, then the oldest ones, once over threshold
+            self._shared = FileSystemCache(SEARCH_CACHE_DIR, threshold=max_entries, default_timeout=ttl)
+
+    def get(self, key):
+        if self.backend == "none":
+            return None
+        if self._shared is not None:
+            value = self._shared.get(key)
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] < time.monotonic():
+                    self._evict(key)
+                    entry = None
+                if entry:
+                    self._entries.move_to_end(key)
+                value = entry[1] if entry else None
+        with self._lock:
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.backend == "none":
+            return
+        if self._shared is not None:
+            self._shared.set(key, value)
+            return
+        size = len(json.dumps(value).encode('utf-8'))
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            stats = {
+                'backend': self.backend,
+                'ttl_seconds': self.ttl,
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else None,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+        if self._shared is not None:
+            files = list(self._shared._list_dir())  # skips cachelib's own bookkeeping file
+            stats['entries'] = len(files)
+            stats['bytes'] = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+        return stats
+
+
+search_cache = SearchResultCache(SEARCH_CACHE_BACKEND, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+
+
+async def perform_web_search(query: str):
     print(f"--- Performing web search for: '{query}' ---")
     langsearch_api_key = os.getenv("LANGSEARCH_API_KEY")
     if not langsearch_api_key:
@@ -259,7 +691,14 @@ def perform_web_search(query: str):
         enhanced_query = f"{query} after:{date_string}"
         print(f"--- Enhanced search query: '{enhanced_query}' ---")
         search_payload = {"query": enhanced_query, "freshness": "Past week"}
-        search_response = requests.post(
+
+        cache_key = f"web_search:{search_payload['freshness']}:{date_string}:{normalize_search_query(query)}"
+        cached = search_cache.get(cache_key)
+        if cached:
+            print("--- Web search cache hit ---")
+            return cached['sources'], cached['context']
+
+        search_response = await get_async_clients()['http'].post(
             "https://api.langsearch.com/v1/web-search",
             headers={"Authorization": f"Bearer {langsearch_api_key}", "Content-Type": "application/json"},
             json=search_payload, timeout=15
@@ -274,13 +713,61 @@ def perform_web_search(query: str):
             context += f"[{i+1}] Title: {title}\nURL: {url}\nSnippet: {snippet}\n\n"
             if url:
                 sources.append({"title": title, "url": url})
+        search_cache.set(cache_key, {'sources': sources, 'context': context})
         return sources, context
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error calling Langsearch API: {e}")
         return [], f"An error occurred during web search: {e}"
 
 
 
+# --- Speculative Web Search ---
+# When enabled, a search for the raw user message starts as soon as /chat is
+# hit, overlapping with the first model call. If the model then asks for a
+# similar query the prefetched result is reused, otherwise it is cancelled.
+SPECULATIVE_SEARCH = os.getenv("SPECULATIVE_SEARCH", "False") == "True"
+SPECULATIVE_SEARCH_SIMILARITY = float(os.getenv("SPECULATIVE_SEARCH_SIMILARITY", "0.6"))
+
+
+class SpeculativeSearchStats:
+    """Counts how often a prefetched search was reused (hit), replaced (miss) or never needed (unused).
+
+    Forced searches always reuse the prefetch, so they are counted apart and left out of the hit rate.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'started': 0, 'hits': 0, 'misses': 0, 'unused': 0, 'forced': 0}
+
+    def record(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        resolved = counts['hits'] + counts['misses']
+        counts['enabled'] = SPECULATIVE_SEARCH
+        counts['hit_rate'] = counts['hits'] / resolved if resolved else None
+        return counts
+
+
+speculative_search_stats = SpeculativeSearchStats()
+
+
+def search_queries_match(prefetched_query, search_query):
+    """Overlap coefficient of the two queries' word sets, so extra words the model adds don't cause a miss."""
+    a, b = set(normalize_search_query(prefetched_query).split()), set(normalize_search_query(search_query).split())
+    if not a or not b:
+        return False
+    return len(a & b) / min(len(a), len(b)) >= SPECULATIVE_SEARCH_SIMILARITY
+
+
+def payload_allows_tool_calls(payload):
+    return bool(payload.get('tools')) and payload.get('tool_choice') != 'none'
+
+
+
 
 
 
@@ -291,37 +778,371 @@ def allowed_file(filename):
 
 
 
-def resize_image_if_needed(image_data, max_size=(1024, 1024), max_file_size_mb=5):
-    """Resize image if it's too large"""
+# --- Upload Ingestion ---
+# Uploads are spooled to disk past a small in-memory threshold and never read whole:
+# the image header is checked first, so oversized or disguised files are rejected
+# before Pillow allocates anything for their pixels.
+UPLOAD_SPOOL_MAX_MEMORY = int(os.getenv("UPLOAD_SPOOL_MAX_MEMORY", str(256 * 1024)))
+MAX_UPLOAD_DIMENSION = int(os.getenv("MAX_UPLOAD_DIMENSION", "12000"))
+MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_PIXELS", "50000000"))
+ALLOWED_IMAGE_FORMATS = {'PNG', 'JPEG', 'MPO', 'GIF', 'WEBP', 'BMP'}
+
+
+class SpooledUploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY, mode='rb+')
+
+
+app.request_class = SpooledUploadRequest
+
+
+def inspect_image_header(stream):
+    """Reads only the image header. Returns an error message, or None if the image may be decoded."""
     try:
-        # Open image from bytes
-        img = Image.open(io.BytesIO(image_data))
+        img = Image.open(stream)
+        image_format, (width, height) = img.format, img.size
+    except Image.DecompressionBombError:
+        return 'Image dimensions are too large'
+    except Exception:
+        return 'Not a valid image'
+    finally:
+        stream.seek(0)
+
+    if image_format not in ALLOWED_IMAGE_FORMATS:
+        return f'Unsupported image format {image_format}'
+    if width > MAX_UPLOAD_DIMENSION or height > MAX_UPLOAD_DIMENSION or width * height > MAX_UPLOAD_PIXELS:
+        return f'Image dimensions {width}x{height} are too large'
+    return None
+
+
+
+# --- Image Output Format ---
+# Resized images are encoded as WebP for models that accept it (typically 25-35%
+# smaller than JPEG at equal quality) and as JPEG otherwise. "jpeg" forces JPEG.
+def env_model_prefixes(name, default):
+    """A comma-separated env var of model id prefixes, as a tuple for str.startswith."""
+    return tuple(prefix.strip() for prefix in os.getenv(name, default).split(",") if prefix.strip())
+
+
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "auto")  # auto | jpeg
+IMAGE_WEBP_MODEL_PREFIXES = env_model_prefixes(
+    "IMAGE_WEBP_MODEL_PREFIXES", "openai/,anthropic/,google/,x-ai/,qwen/,meta-llama/,mistralai/"
+)
+OUTPUT_MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+ENCODER_OPTIONS = {'JPEG': {'optimize': True}, 'WEBP': {'method': 4}}
+# Rough worst-case JPEG bytes per pixel at each quality, used to pick the quality before
+# encoding. WebP comes in under these, so the same table is safe for both.
+OUTPUT_BYTES_PER_PIXEL = ((85, 1.5), (75, 1.0), (60, 0.7))
+
+
+def image_output_format(model):
+    """'WEBP' if the policy allows it and the model accepts WebP input, otherwise 'JPEG'."""
+    if IMAGE_OUTPUT_FORMAT == 'auto' and model and model.startswith(IMAGE_WEBP_MODEL_PREFIXES):
+        return 'WEBP'
+    return 'JPEG'
+
+
+def accepted_image_formats(output_format):
+    """Formats passed to the model as-is when they already fit the limits."""
+    return {'JPEG', 'PNG', 'WEBP'} if output_format == 'WEBP' else {'JPEG', 'PNG'}
+
+
+def read_image_source(source):
+    source.seek(0)
+    return source.read()
+
+
+# Image.info keys for EXIF (which holds GPS) and XMP, as JPEG, PNG and WebP headers report them
+IMAGE_METADATA_KEYS = frozenset({'exif', 'xmp', 'XML:com.adobe.xmp'})
+
+
+def resize_image_if_needed(image_data, max_size=(1024, 1024), max_file_size_mb=5, output_format='JPEG'):
+    """Resize image if it's too large. Takes bytes or a seekable binary file.
+
+    Returns (bytes, mime_type); mime_type is None if the image couldn't be processed
+    and the original bytes are returned.
+    """
+    source = io.BytesIO(image_data) if isinstance(image_data, (bytes, bytearray)) else image_data
+    try:
+        max_bytes = max_file_size_mb * 1024 * 1024
+        source_size = source.seek(0, io.SEEK_END)
+        source.seek(0)
+
+        # Open image (only the header is read until pixels are needed)
+        img = Image.open(source)
+
+        # Already small enough and in a format the model takes: skip the decode/re-encode entirely,
+        # unless it carries EXIF (GPS) or XMP metadata, which only re-encoding drops
+        if (img.format in accepted_image_formats(output_format) and source_size <= max_bytes
+                and img.width <= max_size[0] and img.height <= max_size[1]
+                and not IMAGE_METADATA_KEYS.intersection(img.info)):
+            return read_image_source(source), OUTPUT_MIME_TYPES[img.format]
+
+        # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding, staying at or above max_size
+        if img.format in ('JPEG', 'MPO'):
+            img.draft('RGB', max_size)
         
-        # Convert to RGB if necessary (for JPEG compatibility)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
+        # Convert to a mode the output format can hold; only WebP keeps transparency
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        target_mode = 'RGBA' if has_alpha and output_format == 'WEBP' else 'RGB'
+        if img.mode not in (target_mode, 'L'):
+            img = img.convert(target_mode)
         
         # Resize if needed
         img.thumbnail(max_size, Image.Resampling.LANCZOS)
+
+        # Pick the quality from the pixel budget so the image is normally encoded once
+        bytes_per_pixel = max_bytes / (img.width * img.height)
+        quality = next((q for q, bpp in OUTPUT_BYTES_PER_PIXEL if bpp <= bytes_per_pixel), 60)
         
         # Save back to bytes with quality optimization
         output = io.BytesIO()
-        img.save(output, format='JPEG', quality=85, optimize=True)
+        img.save(output, format=output_format, quality=quality, **ENCODER_OPTIONS[output_format])
         
         resized_data = output.getvalue()
         
-        # Check file size (convert MB to bytes)
-        if len(resized_data) > max_file_size_mb * 1024 * 1024:
+        # Check file size in case the estimate was off
+        if len(resized_data) > max_bytes and quality > 60:
             # If still too large, reduce quality
             output = io.BytesIO()
-            img.save(output, format='JPEG', quality=60, optimize=True)
+            img.save(output, format=output_format, quality=60, **ENCODER_OPTIONS[output_format])
             resized_data = output.getvalue()
         
-        return resized_data
+        return resized_data, OUTPUT_MIME_TYPES[output_format]
     except Exception as e:
         print(f"Error resizing image: {e}")
-        return image_data  # Return original if resize fails
-
+        return read_image_source(source), None  # Return original if resize fails
+
+
+def convert_for_model(img_data, model):
+    """Re-encodes a resolved /chat image the model can't take (e.g. WebP uploaded for another model)."""
+    output_format = image_output_format(model)
+    if img_data['mime_type'] in {OUTPUT_MIME_TYPES[f] for f in accepted_image_formats(output_format)}:
+        return img_data
+    data, mime_type = resize_image_if_needed(img_data['data'], output_format=output_format)
+    if mime_type is None:
+        return img_data
+    return dict(img_data, data=data, mime_type=mime_type, hash=hashlib.sha256(data).hexdigest())
+
+
+
+# --- Image Store ---
+# /upload_images keeps the resized bytes server-side under their SHA-256 and hands
+# the browser a short handle; /chat resolves handles instead of receiving base64.
+# IMAGE_STORE=local keeps them in IMAGE_STORE_DIR, which only works if every request
+# reaches the same host (or the directory is shared). IMAGE_STORE=bucket keeps them
+# under uploads/ in the chat image bucket instead, and is the default on Vercel,
+# where /upload_images and /chat can run on different instances. Images expire
+# IMAGE_STORE_TTL seconds after their last upload (0 keeps them forever) and put()
+# sweeps expired ones at most every IMAGE_STORE_SWEEP_INTERVAL seconds.
+IMAGE_STORE = os.getenv("IMAGE_STORE", "bucket" if os.getenv("VERCEL") else "local")  # local | bucket
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "/tmp/srushti-image-store")
+IMAGE_STORE_TTL = float(os.getenv("IMAGE_STORE_TTL", "86400"))
+IMAGE_STORE_SWEEP_INTERVAL = float(os.getenv("IMAGE_STORE_SWEEP_INTERVAL", "600"))
+IMAGE_HANDLE_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ImageStore:
+    """Content-addressed image files on disk; identical uploads share one file."""
+
+    def __init__(self, root, ttl=IMAGE_STORE_TTL, sweep_interval=IMAGE_STORE_SWEEP_INTERVAL):
+        self.root = root
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._sweep_lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, handle):
+        return os.path.join(self.root, handle[:2], handle)
+
+    def _expired(self, mtime):
+        return self.ttl > 0 and mtime < time.time() - self.ttl
+
+    def put(self, data, mime_type):
+        handle = hashlib.sha256(data).hexdigest()
+        path = self._path(handle)
+        try:
+            # Uploading the same image again restarts its TTL
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so readers never see a partial file; metadata lands first
+            suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(f"{path}.json{suffix}", 'w') as f:
+                json.dump({'mime_type': mime_type}, f)
+            os.replace(f"{path}.json{suffix}", f"{path}.json")
+            with open(f"{path}{suffix}", 'wb') as f:
+                f.write(data)
+            os.replace(f"{path}{suffix}", path)
+        self._maybe_sweep()
+        return handle
+
+    def get(self, handle):
+        """Returns (bytes, mime_type), or None for an unknown or expired handle."""
+        if not IMAGE_HANDLE_PATTERN.match(handle or ''):
+            return None
+        path = self._path(handle)
+        try:
+            with open(path, 'rb') as f:
+                if self._expired(os.fstat(f.fileno()).st_mtime):
+                    return None
+                data = f.read()
+            with open(f"{path}.json") as f:
+                mime_type = json.load(f)['mime_type']
+        except (OSError, ValueError, KeyError):
+            return None
+        return data, mime_type
+
+    def _maybe_sweep(self):
+        if self.ttl <= 0 or time.monotonic() < self._next_sweep or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = time.monotonic() + self.sweep_interval
+            removed = self.sweep()
+            if removed:
+                print(f"🧹 Removed {removed} expired image(s) from the image store")
+        except Exception as e:
+            # Cleanup is best effort; the upload that triggered it already succeeded
+            print(f"Image store sweep failed: {e}")
+        finally:
+            self._sweep_lock.release()
+
+    def sweep(self):
+        """Deletes images (and leftover temp files) not uploaded within the TTL. Returns how many images went."""
+        removed = 0
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    if not self._expired(entry.stat().st_mtime):
+                        continue
+                    # The image goes before its metadata, so get() never finds one without the other
+                    if IMAGE_HANDLE_PATTERN.match(entry.name):
+                        os.remove(entry.path)
+                        try:
+                            os.remove(f"{entry.path}.json")
+                        except FileNotFoundError:
+                            pass
+                        removed += 1
+                    elif entry.name.endswith('.tmp') or not os.path.exists(entry.path.removesuffix('.json')):
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+class BucketImageStore(ImageStore):
+    """ImageStore on the chat image bucket, so any host can resolve a handle."""
+
+    def __init__(self, prefix, ttl=IMAGE_STORE_TTL, sweep_interval=IMAGE_STORE_SWEEP_INTERVAL, sweep_batch=1000):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._sweep_lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def _bucket(self):
+        return supabase.storage.from_(CHAT_IMAGES_BUCKET)
+
+    def _path(self, handle):
+        return f"{self.prefix}/{handle}"
+
+    def put(self, data, mime_type):
+        handle = hashlib.sha256(data).hexdigest()
+        # Upsert also bumps updated_at, so uploading the same image again restarts its TTL
+        self._bucket().upload(self._path(handle), data, {"content-type": mime_type, "upsert": "true"})
+        self._maybe_sweep()
+        return handle
+
+    def get(self, handle):
+        """Returns (bytes, mime_type), or None for an unknown or swept handle."""
+        if not IMAGE_HANDLE_PATTERN.match(handle or ''):
+            return None
+        try:
+            data = self._bucket().download(self._path(handle))
+            # Stored objects are validated uploads, so the header names the type
+            with Image.open(io.BytesIO(data)) as img:
+                mime_type = Image.MIME[img.format]
+        except Exception as e:
+            print(f"Could not read stored image {handle}: {e}")
+            return None
+        return data, mime_type
+
+    def sweep(self):
+        """Deletes the oldest images not uploaded within the TTL, up to sweep_batch. Returns how many went."""
+        entries = self._bucket().list(self.prefix, {
+            'limit': self.sweep_batch, 'sortBy': {'column': 'updated_at', 'order': 'asc'},
+        })
+        expired = []
+        for entry in entries:
+            if not entry.get('updated_at'):
+                continue
+            # Storage reports UTC; seconds are plenty here (and fromisoformat < 3.11 rejects 'Z')
+            updated_at = datetime.fromisoformat(entry['updated_at'][:19]).replace(tzinfo=timezone.utc)
+            if not self._expired(updated_at.timestamp()):
+                break
+            expired.append(self._path(entry['name']))
+        if expired:
+            self._bucket().remove(expired)
+        return len(expired)
+
+
+if IMAGE_STORE == 'bucket':
+    image_store = BucketImageStore("uploads")
+else:
+    if os.getenv("VERCEL"):
+        print(f"⚠️ IMAGE_STORE=local on Vercel: image handles in {IMAGE_STORE_DIR} only resolve on the instance that stored them")
+    image_store = ImageStore(IMAGE_STORE_DIR)
+
+
+def resolve_chat_images(images_data):
+    """Turns /chat image entries into {'data', 'hash', 'mime_type', 'filename'}. None if a handle is unknown."""
+    resolved = []
+    for img_data in images_data:
+        if 'handle' in img_data:
+            stored = image_store.get(str(img_data['handle']))
+            if stored is None:
+                return None
+            data, mime_type = stored
+        else:
+            # Clients loaded before handles existed still post base64
+            data, mime_type = base64.b64decode(img_data['image_data']), img_data['mime_type']
+        resolved.append({
+            'data': data,
+            'hash': hashlib.sha256(data).hexdigest(),
+            'mime_type': mime_type,
+            'filename': secure_filename(img_data.get('filename') or 'image')
+        })
+    return resolved
+
+
+
+# Decode/resize/encode is CPU-bound and independent per image. Pillow releases the
+# GIL in those steps, so a thread pool sized to the cores runs them in parallel
+# without copying image bytes into worker processes.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+
+def process_uploaded_image(image_file, filename, output_format):
+    """Resizes one upload and stores it. Returns the entry /upload_images sends back."""
+    # Resize if needed, decoding straight from the spooled upload
+    resized_data, mime_type = resize_image_if_needed(image_file, output_format=output_format)
+
+    # The encoder decides the mime type; only an unprocessable original falls back to its name
+    mime_type = mime_type or mimetypes.guess_type(filename)[0] or 'image/jpeg'
+
+    # Keep the bytes server-side; the browser only gets a handle
+    handle = image_store.put(resized_data, mime_type)
+
+    return {
+        'handle': handle,
+        'mime_type': mime_type,
+        'filename': secure_filename(filename)
+    }
 
 
 # ✅ ENHANCED: Multi-image upload route
@@ -335,33 +1156,35 @@ def upload_images():
     
     if not files or all(file.filename == '' for file in files):
         return jsonify({'error': 'No images selected'}), 400
-    
-    processed_images = []
-    
+
+    uploads = []
     for file in files:
-        if file and allowed_file(file.filename):
-            try:
-                # Read image data
-                image_data = file.read()
-                
-                # Resize if needed
-                resized_data = resize_image_if_needed(image_data)
-                
-                # Convert to base64
-                base64_image = base64.b64encode(resized_data).decode('utf-8')
-                
-                # Get mime type
-                mime_type = mimetypes.guess_type(file.filename)[0] or 'image/jpeg'
-                
-                processed_images.append({
-                    'image_data': base64_image,
-                    'mime_type': mime_type,
-                    'filename': secure_filename(file.filename)
-                })
-                
-            except Exception as e:
-                print(f"Error processing image {file.filename}: {e}")
-                return jsonify({'error': f'Error processing image {file.filename}: {str(e)}'}), 500
+        if not (file and allowed_file(file.filename)):
+            continue
+        # Reject on the header alone, before the body is read or decoded
+        error = inspect_image_header(file.stream)
+        if error:
+            return jsonify({'error': f'{file.filename}: {error}'}), 400
+        uploads.append((file.stream, file.filename))
+
+    # Encode for the model the images are being attached for
+    output_format = image_output_format(request.form.get('model'))
+
+    # Process all images concurrently, each reading from its own spooled file
+    futures = [
+        image_executor.submit(process_uploaded_image, stream, filename, output_format)
+        for stream, filename in uploads
+    ]
+
+    processed_images = []
+    for future, (_, filename) in zip(futures, uploads):
+        try:
+            image = future.result()
+        except Exception as e:
+            print(f"Error processing image {filename}: {e}")
+            return jsonify({'error': f'Error processing image {filename}: {str(e)}'}), 500
+        image['url'] = url_for('get_image', handle=image['handle'])
+        processed_images.append(image)
     
     if not processed_images:
         return jsonify({'error': 'No valid images processed'}), 400
@@ -372,391 +1195,1727 @@ def upload_images():
     })
 
 
-
-# ✅ ENHANCED: Chat route with multi-image support
-@app.route('/chat', methods=['POST'])
+@app.route('/images/<handle>')
 @login_required
-def chat():
-    chat_data = request.json
-    user_id = session['user']['id']
+def get_image(handle):
+    stored = image_store.get(handle)
+    if stored is None:
+        return jsonify({'error': 'Image not found'}), 404
+    data, mime_type = stored
+    response = Response(data, mimetype=mime_type)
+    # Handles are content hashes, so the bytes behind one never change
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+
+# --- Conversation History Cache ---
+# /chat builds history server-side from the messages table instead of trusting
+# a client-uploaded transcript. Each conversation's history is cached in memory
+# and appended to as turns complete, so steady-state turns need no DB reads.
+# The client sends how many saved messages it has seen; a mismatch (e.g. the
+# previous turn ran on another worker) forces a reload.
+HISTORY_CACHE_MAX_CONVERSATIONS = int(os.getenv("HISTORY_CACHE_MAX_CONVERSATIONS", "2000"))
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "1800"))
+
+
+class ConversationHistoryCache:
+    """LRU of conversation_id -> owner and upstream-ready history messages."""
+
+    def __init__(self, max_conversations, ttl):
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._loads = 0
+
+    def get(self, conversation_id, user_id, expected_count=None):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if (not entry or entry['user_id'] != user_id
+                    or entry['loaded_at'] + self.ttl < time.monotonic()
+                    or (expected_count is not None and expected_count != len(entry['messages']))):
+                return None
+            self._entries.move_to_end(conversation_id)
+            self._hits += 1
+            return list(entry['messages'])
+
+    def put(self, conversation_id, user_id, messages, loaded=True):
+        with self._lock:
+            self._entries[conversation_id] = {'user_id': user_id, 'messages': list(messages), 'loaded_at': time.monotonic()}
+            self._entries.move_to_end(conversation_id)
+            if loaded:
+                self._loads += 1
+            while len(self._entries) > self.max_conversations:
+                self._entries.popitem(last=False)
+
+    def append(self, conversation_id, messages):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry:
+                entry['messages'].extend(messages)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self._hits + self._loads
+            return {
+                'conversations': len(self._entries),
+                'hits': self._hits,
+                'db_loads': self._loads,
+                'hit_rate': self._hits / lookups if lookups else None,
+            }
+
+
+conversation_history_cache = ConversationHistoryCache(HISTORY_CACHE_MAX_CONVERSATIONS, HISTORY_CACHE_TTL)
+
+
+def load_conversation_history(conversation_id, user_id):
+    """Reads a conversation's history from the DB. Returns None if it doesn't belong to the user."""
+    if not user_owns_conversation(conversation_id, user_id):
+        return None
 
-    def stream(data, current_user_id):
-        user_message = data.get('message')
-        history = data.get('history', [])
-        conversation_id = data.get('conversation_id')
-        model = data.get('model', "openai/gpt-oss-120b")
-        force_web_search = data.get('force_web_search', False)
-        force_thinking = data.get('force_thinking', False)
-
-        HYBRID_REASONING_MODELS = [
-            "deepseek/deepseek-chat-v3.1:free",
-            "x-ai/grok-4-fast:free",
-            "anthropic/claude-3.5-sonnet", 
-            "deepseek/deepseek-r1-lite-preview",
-            # Add other hybrid reasoning models here
-        ]
-
-        is_reasoning_model = any(model_name in model for model_name in HYBRID_REASONING_MODELS)
-        print(f"🧠 Model: {model}, Is reasoning model: {is_reasoning_model}, Force thinking: {force_thinking}")
-        
-        # --- ADDED: Check if the selected model is from Groq ---
-        is_groq_model = model == "openai/gpt-oss-120b"
-        # ----------------------------------------------------
-        
-        # ✅ ENHANCED: Handle multiple images
-        images_data = data.get('images_data', [])  # Array of image objects
+    messages_res = supabase.table('messages')\
+        .select('sender, content')\
+        .eq('conversation_id', conversation_id)\
+        .order('created_at', desc=False)\
+        .execute()
+    history = [
+        {"role": "user" if row['sender'] == 'user' else "assistant", "content": row.get('content') or ""}
+        for row in messages_res.data
+    ]
+    conversation_history_cache.put(conversation_id, user_id, history)
+    return history
+
+
+
+# --- History Compaction ---
+# Long conversations would otherwise resend an ever-growing prompt. Before going
+# upstream the system prompt and the last HISTORY_KEEP_TURNS turns are kept verbatim
+# and older turns are truncated (or dropped, oldest first) to fit the model's budget.
+HISTORY_TOKEN_BUDGETS = {
+    "openai/gpt-oss-120b": 24000,
+    "deepseek/deepseek-chat-v3.1:free": 48000,
+    "x-ai/grok-4-fast:free": 48000,
+    "qwen/qwen3-235b-a22b:free": 24000,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "16000"))
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "4"))
+HISTORY_TRUNCATE_TOKENS = int(os.getenv("HISTORY_TRUNCATE_TOKENS", "200"))
+MESSAGE_OVERHEAD_TOKENS = 4  # role + separators, per OpenAI's chat format
+IMAGE_PART_TOKENS = 765
+
+_token_encoding = None
 
+
+def get_token_encoding():
+    """Loads the tiktoken encoding once; returns None if it can't be fetched (e.g. no network)."""
+    global _token_encoding
+    if _token_encoding is None:
         try:
-            if not conversation_id:
-                new_conv_res = supabase.table('conversations').insert({'user_id': current_user_id, 'title': user_message[:40]}).execute()
-                new_conv_data = new_conv_res.data[0]
-                conversation_id = new_conv_data['id']
-                yield f"event: new_conversation\ndata: {json.dumps({'id': conversation_id, 'title': new_conv_data['title']})}\n\n"
+            _token_encoding = tiktoken.get_encoding("o200k_base")
         except Exception as e:
-            print(f"Error creating new conversation: {e}")
-            yield f"data: {json.dumps(f'Error: Could not start a new conversation. {str(e)}')}\n\n"
-            yield "data: [DONE]\n\n"
+            print(f"Could not load tiktoken encoding, estimating token counts instead: {e}")
+            _token_encoding = False
+    return _token_encoding or None
+
+
+# Load (and possibly download) it at startup instead of inside the first chat turn
+get_token_encoding()
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text):
+    # Cached, so on every turn only the newest messages are actually encoded
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message):
+    content = message.get('content') or ""
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + count_text_tokens(content)
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content:
+        if part.get('type') == 'text':
+            tokens += count_text_tokens(part.get('text', ""))
+        else:
+            tokens += IMAGE_PART_TOKENS
+    return tokens
+
+
+def truncate_message(message, max_tokens):
+    content = message.get('content')
+    if not isinstance(content, str):
+        # Older multimodal turns keep only their text
+        content = " ".join(part.get('text', "") for part in content or [] if part.get('type') == 'text')
+    encoding = get_token_encoding()
+    if encoding is None:
+        shortened = content[:max_tokens * 4]
+    else:
+        shortened = encoding.decode(encoding.encode(content, disallowed_special=())[:max_tokens])
+    if len(shortened) < len(content):
+        shortened += " …[truncated]"
+    return {**message, 'content': shortened}
+
+
+def compact_history(history, fixed_messages, model):
+    """Fits `history` into the model's budget alongside `fixed_messages` (system prompt + new message)."""
+    budget = HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+    keep_count = HISTORY_KEEP_TURNS * 2
+    recent = history[-keep_count:] if keep_count else []
+    older = history[:len(history) - len(recent)]
+
+    original_tokens = sum(count_message_tokens(m) for m in history)
+    used = sum(count_message_tokens(m) for m in fixed_messages) + sum(count_message_tokens(m) for m in recent)
+
+    # Walk older turns newest-first, truncating what doesn't fit and dropping the rest
+    compacted = []
+    for message in reversed(older):
+        tokens = count_message_tokens(message)
+        if used + tokens > budget:
+            message = truncate_message(message, HISTORY_TRUNCATE_TOKENS)
+            tokens = count_message_tokens(message)
+            if used + tokens > budget:
+                break
+        compacted.append(message)
+        used += tokens
+    compacted.reverse()
+
+    result = compacted + recent
+    compacted_tokens = sum(count_message_tokens(m) for m in result)
+    if compacted_tokens < original_tokens:
+        print(f"--- History compacted for {model}: {original_tokens} -> {compacted_tokens} tokens "
+              f"({original_tokens - compacted_tokens} saved, {len(history) - len(result)} messages dropped) ---")
+    return result
+
+
+
+# --- Background Persistence ---
+# Image uploads and message inserts run on worker threads after [DONE] is sent.
+# Jobs are sharded by conversation so turns of one conversation persist in order,
+# and every job is safe to retry: uploads use deterministic paths with upsert and
+# the insert is skipped if the turn's user message (keyed by conversation and
+# created_at) already exists.
+PERSIST_WORKERS = int(os.getenv("PERSIST_WORKERS", "2"))
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "500"))
+PERSIST_MAX_ATTEMPTS = int(os.getenv("PERSIST_MAX_ATTEMPTS", "4"))
+PERSIST_RETRY_BACKOFF = float(os.getenv("PERSIST_RETRY_BACKOFF", "0.5"))
+PERSIST_OVERFLOW_WORKERS = int(os.getenv("PERSIST_OVERFLOW_WORKERS", "4"))
+
+
+# Stored images are keyed by the SHA-256 of their bytes and shared across messages
+# and users, so a re-sent image costs a metadata write instead of an upload. The
+# stored_images table (supabase/stored_images.sql) keeps a reference count per image
+# so cleanup can tell when an object is no longer used.
+CHAT_IMAGES_BUCKET = "chat-images"
+
+
+class StoredImageStats:
+    """Counts chat image uploads vs. duplicates that skipped the upload."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uploaded = 0
+        self.deduplicated = 0
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+
+    def record(self, size, deduplicated):
+        with self._lock:
+            if deduplicated:
+                self.deduplicated += 1
+                self.bytes_saved += size
+            else:
+                self.uploaded += 1
+                self.bytes_uploaded += size
+
+    def snapshot(self):
+        with self._lock:
+            total = self.uploaded + self.deduplicated
+            return {
+                'uploaded': self.uploaded,
+                'deduplicated': self.deduplicated,
+                'dedup_rate': self.deduplicated / total if total else 0.0,
+                'bytes_uploaded': self.bytes_uploaded,
+                'bytes_saved': self.bytes_saved,
+            }
+
+
+stored_image_stats = StoredImageStats()
+
+
+# Each stored image gets a small WebP tile next to it, sized for the 144px (w-36)
+# squares in the chat at 2x density. Its URL is derived from the original's, so
+# messages only keep the original URLs.
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "288"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "75"))
+# storage3's get_public_url() always appends a query string (at least a bare `?`)
+STORED_IMAGE_URL_PATTERN = re.compile(r"/sha256/([0-9a-f]{2})/([0-9a-f]{64})\.\w+(\?[^#]*)?$")
+
+
+def chat_image_path(content_hash, mime_type):
+    extension = mimetypes.guess_extension(mime_type) or ''
+    return f"sha256/{content_hash[:2]}/{content_hash}{extension}"
+
+
+def chat_thumbnail_path(content_hash):
+    return f"sha256/{content_hash[:2]}/{content_hash}_thumb.webp"
+
+
+@app.template_filter('thumbnail_url')
+def thumbnail_url(image_url):
+    """The thumbnail URL for a content-addressed image URL; other URLs are returned unchanged."""
+    return STORED_IMAGE_URL_PATTERN.sub(r"/sha256/\1/\2_thumb.webp\3", image_url or '')
+
+
+def make_thumbnail(image_data):
+    img = Image.open(io.BytesIO(image_data))
+    if img.format in ('JPEG', 'MPO'):
+        img.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode == 'LA' else 'RGB')
+    # Center crop, matching object-cover in the tiles
+    img = ImageOps.fit(img, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format='WEBP', quality=THUMBNAIL_QUALITY, method=4)
+    return output.getvalue()
+
+
+def upload_chat_image(img_data):
+    """Uploads an image and its thumbnail under its content hash unless already stored.
+
+    Returns (path, thumbnail_path). The result is remembered on img_data, so an image
+    uploaded early for a signed URL isn't checked or uploaded again when it's saved.
+    """
+    if 'stored_paths' in img_data:
+        return img_data['stored_paths']
+
+    content_hash = img_data['hash']
+    path = chat_image_path(content_hash, img_data['mime_type'])
+    bucket = supabase.storage.from_(CHAT_IMAGES_BUCKET)
+
+    existing = supabase.table('stored_images')\
+        .select('hash, thumbnail_path, ref_count')\
+        .eq('hash', content_hash)\
+        .execute()
+    # A row at ref_count 0 means its objects may already have been cleaned up, so upload again
+    referenced = bool(existing.data) and existing.data[0].get('ref_count', 0) > 0
+    if not referenced:
+        bucket.upload(path, img_data['data'], {"content-type": img_data['mime_type'], "upsert": "true"})
+    stored_image_stats.record(len(img_data['data']), deduplicated=referenced)
+
+    # Rows stored before thumbnails existed get theirs on the next reference
+    thumbnail_path = existing.data[0].get('thumbnail_path') if referenced else None
+    if not thumbnail_path:
+        thumbnail_path = chat_thumbnail_path(content_hash)
+        bucket.upload(thumbnail_path, make_thumbnail(img_data['data']), {"content-type": "image/webp", "upsert": "true"})
+
+    img_data['stored_paths'] = (path, thumbnail_path)
+    return path, thumbnail_path
+
+
+def store_chat_image(img_data):
+    """Uploads an image if needed and takes a reference to it. Returns its public URL.
+
+    Uploading before taking the reference means a failure in between only leaves an
+    unreferenced object, never a dangling row.
+    """
+    path, thumbnail_path = upload_chat_image(img_data)
+    supabase.rpc('acquire_stored_image', {
+        'p_hash': img_data['hash'],
+        'p_path': path,
+        'p_mime_type': img_data['mime_type'],
+        'p_size': len(img_data['data']),
+        'p_thumbnail_path': thumbnail_path,
+    }).execute()
+    return supabase.storage.from_(CHAT_IMAGES_BUCKET).get_public_url(path)
+
+
+# --- Upstream Image Delivery ---
+# For models whose providers fetch remote images, images are uploaded before the
+# completion and sent as short-lived signed URLs instead of inline base64, which
+# keeps the upstream request body small. Any failure falls back to inline base64.
+IMAGE_URL_DELIVERY = os.getenv("IMAGE_URL_DELIVERY", "False") == "True"
+IMAGE_SIGNED_URL_TTL = int(os.getenv("IMAGE_SIGNED_URL_TTL", "600"))
+REMOTE_IMAGE_URL_MODEL_PREFIXES = env_model_prefixes(
+    "REMOTE_IMAGE_URL_MODEL_PREFIXES", "openai/,anthropic/,google/,x-ai/,mistralai/,meta-llama/,qwen/"
+)
+
+
+def supports_remote_image_urls(model):
+    return IMAGE_URL_DELIVERY and bool(model) and model.startswith(REMOTE_IMAGE_URL_MODEL_PREFIXES)
+
+
+def inline_image_url(img_data):
+    return f"data:{img_data['mime_type']};base64,{base64.b64encode(img_data['data']).decode('ascii')}"
+
+
+def signed_image_url(img_data):
+    path, _ = upload_chat_image(img_data)
+    return supabase.storage.from_(CHAT_IMAGES_BUCKET).create_signed_url(path, IMAGE_SIGNED_URL_TTL)['signedURL']
+
+
+async def build_image_parts(images_data, model):
+    """image_url content parts for the current turn, signed URLs where possible."""
+    async def image_url(img_data):
+        if supports_remote_image_urls(model):
+            try:
+                return await asyncio.to_thread(signed_image_url, img_data)
+            except Exception as e:
+                print(f"Could not sign image URL, sending it inline: {e}")
+        return inline_image_url(img_data)
+
+    urls = await asyncio.gather(*(image_url(img_data) for img_data in images_data))
+    return [{"type": "image_url", "image_url": {"url": url, "detail": "auto"}} for url in urls]
+
+
+class PersistTurnJob:
+    """Uploads a turn's images and inserts its user and AI messages."""
+
+    def __init__(self, user_id, user_message_data, ai_message_data, images_data):
+        self.user_id = user_id
+        self.conversation_id = user_message_data['conversation_id']
+        self.user_message_data = user_message_data
+        self.ai_message_data = ai_message_data
+        self.images_data = images_data or []
+        self.key = f"{self.conversation_id}:{user_message_data['created_at']}"
+        self.image_urls = {}  # index -> public URL, kept across retries
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+    def run(self, final_attempt=False):
+        self.attempts += 1
+        if self.images_data:
+            self._upload_images(final_attempt)
+            self.user_message_data['has_image'] = True
+            self.user_message_data['image_urls'] = [
+                self.image_urls[i] for i in range(len(self.images_data)) if i in self.image_urls
+            ]
+
+        # A previous attempt may have committed the insert before failing
+        if self.attempts > 1 and self._already_saved():
             return
-        
-        # ✅ ENHANCED: Build message content with multiple images support
-        message_content = []
-        
-        # Add text content
-        if user_message:
-            message_content.append({
-                "type": "text",
-                "text": user_message
-            })
-        
-        # Add multiple images content if present
-        for img_data in images_data:
-            message_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{img_data['mime_type']};base64,{img_data['image_data']}",
-                    "detail": "auto"
-                }
-            })
-        
-        # Build messages array
-        messages = [
-            {
-                "role": "system",
-                "content": "You are Srushti, an AI trained by Shreyash shastri. Write like a human, Keep your responses professional but conversational. Don't use em dashes or buzzwords. Avoid sounding like a press release, dont use very high level language, keep it natural and also use emojis to keep it friendly, use high level language only when requested by user. Be Clear Direct and natural, like you're writing to a smart friend. Always Use web_search function to find relevant info. Always keep the user engaged, and Please dont write the search results, its just for you to understand, dont mention it in response no matter what. Tell the user only what they have asked; don't introduce additional topics. Keep your answers concise and strictly relevant. "},
-            *history,
-            {"role": "user", "content": message_content if len(message_content) > 1 else user_message}
-        ]
-        
-        full_ai_response, sources, all_reasoning = "", [], ""
+        supabase.table('messages').insert([self.user_message_data, self.ai_message_data]).execute()
+
+    def _upload_images(self, final_attempt):
+        for i, img_data in enumerate(self.images_data):
+            # Done images keep their URL, so a retry never takes a second reference
+            if i in self.image_urls:
+                continue
+            try:
+                self.image_urls[i] = store_chat_image(img_data)
+            except Exception as e:
+                # Out of retries: save the message without the image rather than losing the turn
+                if not final_attempt:
+                    raise
+                print(f"Error uploading image: {e}")
+
+    def _already_saved(self):
+        existing = supabase.table('messages')\
+            .select('id')\
+            .eq('conversation_id', self.conversation_id)\
+            .eq('sender', 'user')\
+            .eq('created_at', self.user_message_data['created_at'])\
+            .limit(1)\
+            .execute()
+        return bool(existing.data)
+
+
+class PersistenceQueue:
+    """Bounded, sharded background queue for PersistTurnJob with retries and metrics."""
+
+    def __init__(self, workers, max_size, max_attempts, retry_backoff):
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._lock = threading.Lock()
+        self._pending = set()  # keys queued or running, so the same turn isn't persisted twice
+        self._queues = [queue.Queue(maxsize=max(1, max_size // workers)) for _ in range(workers)]
+        self.enqueued = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.latency_total_ms = 0.0
+        self.latency_max_ms = 0.0
+        for i, shard in enumerate(self._queues):
+            threading.Thread(target=self._worker, args=(shard,), name=f"persist-{i}", daemon=True).start()
+
+    def submit(self, job):
+        """Queues the job. Returns False if the queue is full so the caller can run it inline."""
+        with self._lock:
+            if job.key in self._pending:
+                return True
+            self._pending.add(job.key)
+        shard = self._queues[hash(job.conversation_id) % len(self._queues)]
+        try:
+            shard.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(job.key)
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def run(self, job):
+        """Runs a job to completion with retries. Returns True if it was saved."""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                job.run(final_attempt=attempt == self.max_attempts)
+                self._record(job, ok=True)
+                return True
+            except Exception as e:
+                print(f"Error saving conversation to database (attempt {attempt}/{self.max_attempts}): {e}")
+                if attempt == self.max_attempts:
+                    traceback.print_exc()
+                    break
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+        self._record(job, ok=False)
+        return False
+
+    def _worker(self, shard):
+        while True:
+            job = shard.get()
+            try:
+                self.run(job)
+            finally:
+                with self._lock:
+                    self._pending.discard(job.key)
+                shard.task_done()
+
+    def _record(self, job, ok):
+        latency_ms = (time.monotonic() - job.enqueued_at) * 1000
+        with self._lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.latency_total_ms += latency_ms
+            self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+
+    def snapshot(self):
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                'depth': sum(shard.qsize() for shard in self._queues),
+                'pending': len(self._pending),
+                'enqueued': self.enqueued,
+                'completed': self.completed,
+                'failed': self.failed,
+                'retries': self.retries,
+                'rejected': self.rejected,
+                'avg_latency_ms': self.latency_total_ms / finished if finished else 0.0,
+                'max_latency_ms': self.latency_max_ms,
+            }
+
+
+persistence_queue = PersistenceQueue(
+    PERSIST_WORKERS, PERSIST_QUEUE_SIZE, PERSIST_MAX_ATTEMPTS, PERSIST_RETRY_BACKOFF
+)
+# When the queue is full the turn saves inline, retries and backoff sleeps included.
+# That runs on its own pool so a slow Supabase can't tie up the event loop's default
+# executor, which every other stream needs for its queries and history compaction.
+persist_overflow_executor = ThreadPoolExecutor(max_workers=PERSIST_OVERFLOW_WORKERS, thread_name_prefix="persist-overflow")
+
+
+
+# --- Async Streaming Engine ---
+# Upstream completions are streamed over the pooled upstream client, so a single
+# process can multiplex hundreds of SSE streams instead of pinning a worker
+# thread per in-flight generation.
+
+_stream_loop = None
+_stream_loop_lock = threading.Lock()
+
+
+def get_stream_loop():
+    """Starts (once per process) the background event loop used by the WSGI /chat route."""
+    global _stream_loop
+    with _stream_loop_lock:
+        if _stream_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="stream-loop", daemon=True).start()
+            _stream_loop = loop
+    return _stream_loop
+
+
+def iter_async_stream(agen, loop=None):
+    """Runs an async generator on the shared stream loop (or `loop`) and yields its items to a WSGI response."""
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in async stream: {e}")
+            traceback.print_exc()
+        finally:
+            await agen.aclose()
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop or get_stream_loop())
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # Client went away (or we finished): stop the upstream stream too
+        future.cancel()
+
+
+# --- SSE Coalescing ---
+# Upstream deltas are often a character or two. Sending each as its own frame costs a
+# JSON encode, a write and a packet per delta, and the browser re-renders the whole
+# message per frame, so consecutive deltas are batched into one frame per flush window.
+SSE_FLUSH_INTERVAL_MS = float(os.getenv("SSE_FLUSH_INTERVAL_MS", "50"))  # 0 sends every delta as it arrives
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "1024"))
+
+
+class SSEDelta:
+    """A piece of streamed text for the default (`data:`) or a named SSE event."""
+    __slots__ = ('event', 'text')
+
+    def __init__(self, text, event=None):
+        self.text = text
+        self.event = event
+
+
+def sse_frame(event, text):
+    if event:
+        return f"event: {event}\ndata: {json.dumps(text)}\n\n"
+    return f"data: {json.dumps(text)}\n\n"
+
+
+class SSECoalescingStats:
+    """Deltas received vs frames sent by the /chat coalescing stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.deltas = 0
+        self.frames = 0
+
+    def record(self, deltas, frames):
+        with self._lock:
+            self.responses += 1
+            self.deltas += deltas
+            self.frames += frames
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'flush_interval_ms': SSE_FLUSH_INTERVAL_MS,
+                'flush_bytes': SSE_FLUSH_BYTES,
+                'responses': self.responses,
+                'deltas': self.deltas,
+                'frames': self.frames,
+                'avg_frames_per_response': self.frames / self.responses if self.responses else 0.0,
+            }
+
+
+sse_coalescing_stats = SSECoalescingStats()
+
+
+async def coalesce_sse(agen, interval_ms=None, max_bytes=None):
+    """Turns a stream of SSEDelta items and ready-made frames into SSE frames.
+
+    Consecutive deltas for the same event are joined and flushed when `interval_ms`
+    has passed since the first buffered one or `max_bytes` are buffered, whichever
+    comes first. The first delta of each event goes out immediately, and anything
+    buffered is flushed before a ready-made frame and at the end of the stream.
+    """
+    interval_ms = SSE_FLUSH_INTERVAL_MS if interval_ms is None else interval_ms
+    max_bytes = SSE_FLUSH_BYTES if max_bytes is None else max_bytes
+    if interval_ms <= 0:
+        deltas = frames = 0
+        try:
+            async for item in agen:
+                if isinstance(item, SSEDelta):
+                    if not item.text:
+                        continue
+                    deltas += 1
+                    item = sse_frame(item.event, item.text)
+                frames += 1
+                yield item
+        finally:
+            await agen.aclose()
+            sse_coalescing_stats.record(deltas, frames)
+        return
+
+    loop = asyncio.get_running_loop()
+    interval = interval_ms / 1000
+
+    # One reader task fills `items` and wakes us; the flush timer wakes us the same
+    # way, so a stalled upstream can't hold buffered text past its window
+    items = deque()
+    state = {'waiter': None, 'finished': False}
+
+    def wake():
+        waiter = state['waiter']
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read():
+        try:
+            async for item in agen:
+                items.append(item)
+                wake()
+        finally:
+            state['finished'] = True
+            wake()
+            await agen.aclose()
+
+    reader = loop.create_task(read())
+    pending_event, pending, pending_size, deadline, timer = None, [], 0, 0.0, None
+    started = set()
+    deltas = frames = 0
+
+    def flush():
+        nonlocal pending, pending_size, timer
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        frame = sse_frame(pending_event, ''.join(pending))
+        pending, pending_size = [], 0
+        return frame
+
+    try:
+        while True:
+            while items:
+                item = items.popleft()
+                if not isinstance(item, SSEDelta):
+                    if pending:
+                        frames += 1
+                        yield flush()
+                    frames += 1
+                    yield item
+                    continue
+                if not item.text:
+                    continue
+
+                deltas += 1
+                if item.event not in started:
+                    started.add(item.event)
+                    frames += 1
+                    yield sse_frame(item.event, item.text)
+                    continue
+                if pending and item.event != pending_event:
+                    frames += 1
+                    yield flush()
+                if not pending:
+                    pending_event, deadline = item.event, loop.time() + interval
+                    timer = loop.call_at(deadline, wake)
+                pending.append(item.text)
+                pending_size += len(item.text)
+                if pending_size >= max_bytes:
+                    frames += 1
+                    yield flush()
+
+            if pending and loop.time() >= deadline:
+                frames += 1
+                yield flush()
+                continue
+            if state['finished']:
+                break
+            state['waiter'] = loop.create_future()
+            await state['waiter']
+            state['waiter'] = None
+
+        if pending:
+            frames += 1
+            yield flush()
+        await reader  # re-raises anything the turn raised
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if not reader.done():
+            reader.cancel()
+            try:
+                await reader
+            except BaseException:
+                pass
+        sse_coalescing_stats.record(deltas, frames)
+
+
+# --- Upstream SSE Decoding ---
+# OpenRouter chunks are decoded straight from the response bytes into typed structs
+# with a compiled msgspec schema; only the fields the chat loops read are built.
+
+class ToolCallFunctionDelta(msgspec.Struct):
+    name: str | None = None
+    arguments: str | None = None
+
+
+class ToolCallDelta(msgspec.Struct):
+    index: int = 0
+    id: str | None = None
+    type: str | None = None
+    function: ToolCallFunctionDelta | None = None
+
+
+class StreamDelta(msgspec.Struct):
+    content: str | None = None
+    reasoning: str | None = None
+    tool_calls: list[ToolCallDelta] | None = None
+
+
+class StreamChoice(msgspec.Struct):
+    delta: StreamDelta = msgspec.field(default_factory=StreamDelta)
+    finish_reason: str | None = None
+
+
+class StreamChunk(msgspec.Struct):
+    choices: list[StreamChoice] = []
+
+
+class UpstreamSSEDecoder:
+    """Incremental decoder for an OpenRouter SSE byte stream.
+
+    `feed()` takes raw response bytes and returns the first StreamChoice of every
+    complete `data:` line. Lines are located in place and payloads are handed to msgspec as
+    memoryview slices, so only a trailing partial line is ever copied.
+    """
+    _chunk_decoder = msgspec.json.Decoder(StreamChunk)
+
+    def __init__(self):
+        self._tail = b""
+        self.done = False
+
+    def feed(self, data):
+        if self._tail:
+            data = self._tail + data
+        view = memoryview(data)
+        deltas = []
+        start = 0
+        while not self.done:
+            end = data.find(b"\n", start)
+            if end < 0:
+                break
+            stop = end - 1 if end > start and data[end - 1] == 13 else end  # tolerate \r\n
+            if data.startswith(b"data: ", start, stop):
+                if data.startswith(b"[DONE]", start + 6, stop):
+                    self.done = True
+                    break
+                try:
+                    choices = self._chunk_decoder.decode(view[start + 6:stop]).choices
+                    if choices:
+                        deltas.append(choices[0])
+                except msgspec.DecodeError as e:
+                    print(f"Error parsing chunk: {e}")
+            start = end + 1
+        self._tail = b"" if self.done else data[start:]
+        return deltas
+
+
+async def stream_openrouter(payload, headers):
+    """Yields the StreamChoice (delta and finish_reason) of every chunk of an OpenRouter SSE completion."""
+    client = get_async_clients()['http']
+    async with client.stream("POST", OPENROUTER_CHAT_URL, headers=headers, json=payload) as response:
+        response.raise_for_status()
+        decoder = UpstreamSSEDecoder()
+        async for data in response.aiter_bytes():
+            for choice in decoder.feed(data):
+                yield choice
+            if decoder.done:
+                break
+
+
+# --- Chat Providers ---
+# Every backend turns a chat completion payload into the same stream of typed events,
+# so the chat loop keeps a single accumulator no matter who serves the model.
+
+class ContentEvent(msgspec.Struct):
+    text: str
+
+
+class ReasoningEvent(msgspec.Struct):
+    text: str
+
+
+class DoneEvent(msgspec.Struct):
+    finish_reason: str | None = None
+
+
+# Tool call deltas are passed through as ToolCallDelta
+
+
+def delta_events(delta):
+    """Events for one upstream delta, in the order they should be handled."""
+    events = []
+    if delta.reasoning:
+        events.append(ReasoningEvent(delta.reasoning))
+    if delta.content:
+        events.append(ContentEvent(delta.content))
+    if delta.tool_calls:
+        events.extend(delta.tool_calls)
+    return events
+
+
+class OpenRouterProvider:
+    name = 'openrouter'
+    label = 'OpenRouter'
+
+    async def stream(self, payload):
         headers = {
             "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}", "Content-Type": "application/json",
         }
-        buffered_reasoning, tool_calls = "", None
+        finish_reason = None
+        async for choice in stream_openrouter(payload, headers):
+            for event in delta_events(choice.delta):
+                yield event
+            finish_reason = choice.finish_reason or finish_reason
+        yield DoneEvent(finish_reason)
+
+
+class GroqProvider:
+    name = 'groq'
+    label = 'Groq'
+
+    async def stream(self, payload):
+        response_stream = await get_async_clients()['groq'].chat.completions.create(**payload)
+        finish_reason = None
+        async for chunk in response_stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta
+            tool_calls = None
+            if delta.tool_calls:
+                tool_calls = [
+                    ToolCallDelta(
+                        index=tool_chunk.index,
+                        id=tool_chunk.id,
+                        type=tool_chunk.type,
+                        function=tool_chunk.function and ToolCallFunctionDelta(
+                            name=tool_chunk.function.name, arguments=tool_chunk.function.arguments
+                        ),
+                    )
+                    for tool_chunk in delta.tool_calls
+                ]
+            for event in delta_events(StreamDelta(delta.content, delta.reasoning, tool_calls)):
+                yield event
+            finish_reason = choice.finish_reason or finish_reason
+        yield DoneEvent(finish_reason)
+
+
+CHAT_PROVIDERS = {provider.name: provider for provider in (OpenRouterProvider(), GroqProvider())}
+
+
+class CompletionAccumulator:
+    """Folds one provider event stream into content, reasoning and tool calls."""
+
+    def __init__(self, collect_tool_calls=True):
+        self.collect_tool_calls = collect_tool_calls
+        self.content = ""
+        self.reasoning = ""
+        self.finish_reason = None
+        self._tool_calls = {}
+
+    @property
+    def has_tool_calls(self):
+        return bool(self._tool_calls)
+
+    def add(self, event):
+        if isinstance(event, ContentEvent):
+            self.content += event.text
+        elif isinstance(event, ReasoningEvent):
+            self.reasoning += event.text
+        elif isinstance(event, ToolCallDelta):
+            if self.collect_tool_calls:
+                self._add_tool_call(event)
+        elif isinstance(event, DoneEvent):
+            self.finish_reason = event.finish_reason
+
+    def _add_tool_call(self, tool_chunk):
+        call = self._tool_calls.setdefault(tool_chunk.index, {})
+        if tool_chunk.id: call['id'] = tool_chunk.id
+        if tool_chunk.type: call['type'] = tool_chunk.type
+        if tool_chunk.function:
+            function = call.setdefault('function', {})
+            if tool_chunk.function.name: function['name'] = tool_chunk.function.name
+            if tool_chunk.function.arguments:
+                function['arguments'] = function.get('arguments', "") + tool_chunk.function.arguments
+
+    def tool_calls(self):
+        return list(self._tool_calls.values()) or None
+
+
+# --- Provider Routing ---
+# A model can be served by more than one provider. Time-to-first-token is tracked per
+# route (provider + model); when the first token is later than the route's usual
+# percentile, a hedged duplicate goes to the next route and whichever answers first
+# is kept while the other is cancelled. A route that fails before its first token
+# fails over to the next one straight away.
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "True") == "True"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "3.0"))  # seconds, until a route has enough samples
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+ROUTE_TTFT_WINDOW = int(os.getenv("ROUTE_TTFT_WINDOW", "200"))
+
+# Providers per model, preferred first; models not listed are served by OpenRouter only
+MODEL_ROUTES = {
+    "openai/gpt-oss-120b": ['groq', 'openrouter'],
+}
 
 
+def model_routes(model):
+    return MODEL_ROUTES.get(model, ['openrouter'])
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class RouteStats:
+    """Recent time-to-first-token and hedging outcomes per provider:model route."""
+
+    def __init__(self, window):
+        self._lock = threading.Lock()
+        self._window = window
+        self._routes = {}
+
+    def _route(self, key):
+        route = self._routes.get(key)
+        if route is None:
+            route = self._routes[key] = {
+                'ttft': deque(maxlen=self._window), 'censored': deque(maxlen=self._window),
+                'requests': 0, 'errors': 0, 'hedges': 0, 'wins': 0, 'cancelled': 0,
+            }
+        return route
+
+    def record(self, key, outcome):
+        with self._lock:
+            self._route(key)[outcome] += 1
+
+    def record_ttft(self, key, seconds):
+        with self._lock:
+            self._route(key)['ttft'].append(seconds)
+
+    def record_censored_ttft(self, key, seconds):
+        """A cancelled attempt only shows its TTFT is above `seconds`; kept out of the percentiles."""
+        with self._lock:
+            self._route(key)['censored'].append(seconds)
+
+    def ttft_percentile(self, key, pct):
+        """TTFT percentile in seconds, or None while the route has too few samples."""
+        with self._lock:
+            samples = sorted(self._route(key)['ttft'])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(samples, pct)
+
+    def hedge_delay(self, key):
+        delay = self.ttft_percentile(key, HEDGE_PERCENTILE)
+        return HEDGE_DEFAULT_DELAY if delay is None else max(HEDGE_MIN_DELAY, delay)
+
+    def snapshot(self):
+        with self._lock:
+            routes = {key: dict(route, ttft=sorted(route['ttft']), censored=len(route['censored']))
+                      for key, route in self._routes.items()}
+        result = {}
+        for key, route in routes.items():
+            samples = route.pop('ttft')
+            route['samples'] = len(samples)
+            route['censored_samples'] = route.pop('censored')
+            route['ttft_p50_ms'] = percentile(samples, 50) * 1000 if samples else None
+            route['ttft_p95_ms'] = percentile(samples, 95) * 1000 if samples else None
+            route['hedge_delay_ms'] = self.hedge_delay(key) * 1000
+            result[key] = route
+        return result
+
+
+route_stats = RouteStats(ROUTE_TTFT_WINDOW)
+
+
+def ordered_routes(model):
+    """The model's providers, fastest median TTFT first once every route has enough samples."""
+    providers = model_routes(model)
+    medians = [route_stats.ttft_percentile(f"{name}:{model}", 50) for name in providers]
+    if len(providers) > 1 and None not in medians:
+        providers = [name for _, name in sorted(zip(medians, providers), key=lambda pair: pair[0])]
+    return providers
+
+
+async def routed_stream(model, payloads):
+    """Streams provider events for `model`, hedging and failing over between its routes.
+
+    `payloads` maps provider name to the payload to send to that provider.
+    """
+    remaining = [name for name in ordered_routes(model) if name in payloads]
+    attempts = []
+
+    def launch(name):
+        stream = CHAT_PROVIDERS[name].stream(payloads[name])
+        attempt = {
+            'key': f"{name}:{model}", 'label': CHAT_PROVIDERS[name].label, 'stream': stream,
+            'first': asyncio.ensure_future(stream.__anext__()), 'started': time.perf_counter(),
+        }
+        route_stats.record(attempt['key'], 'requests')
+        attempts.append(attempt)
+        return attempt
 
+    async def close(attempt):
+        attempt['first'].cancel()
         try:
-            print("--- AI is thinking... (Combined Streaming Step) ---")
-            if force_web_search:
-                print(f"--- Web search was forced by user for: '{user_message}' ---")
-                tool_calls = [{"id": "forced_search", "type": "function", "function": {"name": "web_search", "arguments": json.dumps({"query": user_message})}}]
-            else:
-                # ✅ MODIFIED: Only use tools if no images are present (many vision models don't support tools)
-                tools_param = [web_search_tool] if not images_data else []
-                buffered_content, tool_call_chunks = "", {}
-
-                final_api_payload = {
-                    "model": model,
-                    "messages": messages,
-                    "stream": True,
-                    "tool_choice": "none",
-                    "temperature": 0.7,
-                    "max_tokens": 2000
-                }
-
-
-                # Add tools only if no images and not a reasoning model
-                if not images_data and not is_reasoning_model:
-                    final_api_payload["tools"] = tools_param
-
-                if is_reasoning_model:
-                    if force_thinking:
-                        final_api_payload["reasoning"] = {"max_tokens": 2000}
-                        print("🧠 Added FORCED reasoning with 2000 tokens")
-                    else:
-                        final_api_payload["reasoning"] = {"max_tokens": 1000}
-                        print("🧠 Added optional reasoning with 1000 tokens")
-                    print(f"🧠 Final API payload reasoning: {final_api_payload.get('reasoning')}")
-
-                
-                # --- MODIFIED: Use Groq client for the reasoning model ---
-                if is_groq_model:
-                    print("--- Using Groq API for initial call ---")
-                    initial_response_stream = groq_client.chat.completions.create(
-                        model=model,
-                        messages=messages,
-                        tools=tools_param,
-                        stream=True,
-                        max_tokens=4096,
-                    )
+            await attempt['first']
+        except BaseException:
+            pass
+        await attempt['stream'].aclose()
+
+    print(f"--- Using {CHAT_PROVIDERS[remaining[0]].label} API ---")
+    preferred = launch(remaining.pop(0))
+    winner, error = None, None
+    try:
+        while winner is None:
+            timeout = None
+            if HEDGE_REQUESTS and remaining and attempts:
+                latest = attempts[-1]
+                timeout = max(0.0, latest['started'] + route_stats.hedge_delay(latest['key']) - time.perf_counter())
+            done, _ = await asyncio.wait(
+                [attempt['first'] for attempt in attempts], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                hedge = launch(remaining.pop(0))
+                route_stats.record(hedge['key'], 'hedges')
+                print(f"--- First token is late, hedging on {hedge['label']} ---")
+                continue
+
+            for attempt in list(attempts):
+                if attempt['first'] not in done:
+                    continue
+                if attempt['first'].exception() is None:
+                    winner = attempt
+                    break
+                error = attempt['first'].exception()
+                print(f"Route {attempt['key']} failed before its first token: {error}")
+                route_stats.record(attempt['key'], 'errors')
+                attempts.remove(attempt)
+                await close(attempt)
+
+            if winner is None and not attempts:
+                if not remaining:
+                    raise error
+                print(f"--- Failing over to {CHAT_PROVIDERS[remaining[0]].label} ---")
+                launch(remaining.pop(0))
+
+        now = time.perf_counter()
+        route_stats.record_ttft(winner['key'], now - winner['started'])
+        route_stats.record(winner['key'], 'wins')
+        for attempt in attempts:
+            if attempt is not winner:
+                # Only a lower bound on the loser's TTFT (near zero for a hedge launched just before
+                # the win), so it mustn't pull that route's percentiles down
+                route_stats.record_censored_ttft(attempt['key'], now - attempt['started'])
+                route_stats.record(attempt['key'], 'cancelled')
+                await close(attempt)
+        attempts = [winner]
+        if winner is not preferred:
+            print(f"--- {winner['label']} answered first ---")
+
+        yield winner['first'].result()
+        async for event in winner['stream']:
+            yield event
+    finally:
+        for attempt in attempts:
+            await close(attempt)
+
+
+def stream_chat(data, current_user_id):
+    """Runs one chat turn and yields SSE frames. Shared by the WSGI and ASGI /chat routes."""
+    return coalesce_sse(chat_turn_events(data, current_user_id))
+
+
+async def chat_turn_events(data, current_user_id):
+    """Runs one chat turn, yielding SSEDelta text as it streams and SSE frames for everything else."""
+    user_message = data.get('message')
+    conversation_id = data.get('conversation_id')
+    message_count = data.get('message_count')
+    model = data.get('model', "openai/gpt-oss-120b")
+    force_web_search = data.get('force_web_search', False)
+    force_thinking = data.get('force_thinking', False)
+
+    HYBRID_REASONING_MODELS = [
+        "deepseek/deepseek-chat-v3.1:free",
+        "x-ai/grok-4-fast:free",
+        "anthropic/claude-3.5-sonnet",
+        "deepseek/deepseek-r1-lite-preview",
+        # Add other hybrid reasoning models here
+    ]
+
+    is_reasoning_model = any(model_name in model for model_name in HYBRID_REASONING_MODELS)
+    print(f"🧠 Model: {model}, Is reasoning model: {is_reasoning_model}, Force thinking: {force_thinking}")
+
+    # ✅ ENHANCED: Handle multiple images
+    images_data = data.get('images_data', [])  # Array of image objects
+
+    # Explicit timestamps keep the pair ordered and identify the turn for idempotent saves
+    user_created_at = datetime.now(timezone.utc).isoformat()
 
-                    for chunk in initial_response_stream:
-                        delta = chunk.choices[0].delta
-                        if delta.content:
-                            buffered_content += delta.content
-                            if not tool_call_chunks:
-                                yield f"data: {json.dumps(delta.content)}\n\n"
-                        
-                        if delta.tool_calls and not images_data:
-                            for tool_chunk in delta.tool_calls:
-                                index = tool_chunk.index
-                                if index not in tool_call_chunks: tool_call_chunks[index] = {}
-                                if tool_chunk.id: tool_call_chunks[index]['id'] = tool_chunk.id
-                                if tool_chunk.type: tool_call_chunks[index]['type'] = tool_chunk.type
-                                if tool_chunk.function:
-                                    if 'function' not in tool_call_chunks[index]: tool_call_chunks[index]['function'] = {}
-                                    if tool_chunk.function.name: tool_call_chunks[index]['function']['name'] = tool_chunk.function.name
-                                    if tool_chunk.function.arguments:
-                                        if 'arguments' not in tool_call_chunks[index]['function']: tool_call_chunks[index]['function']['arguments'] = ""
-                                        tool_call_chunks[index]['function']['arguments'] += tool_chunk.function.arguments
+    try:
+        # Resolve uploaded image handles before creating anything
+        images_data = await asyncio.to_thread(resolve_chat_images, images_data)
+        if images_data is None:
+            yield f"data: {json.dumps('Error: An attached image has expired. Please upload it again.')}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        if images_data:
+            images_data = await asyncio.to_thread(lambda: [convert_for_model(img, model) for img in images_data])
+
+        if not conversation_id:
+            new_conv_res = await asyncio.to_thread(
+                supabase.table('conversations').insert({'user_id': current_user_id, 'title': user_message[:40]}).execute
+            )
+            new_conv_data = new_conv_res.data[0]
+            conversation_id = new_conv_data['id']
+            conversation_history_cache.put(conversation_id, current_user_id, [], loaded=False)
+            conversation_list_loader.invalidate(current_user_id)
+            yield f"event: new_conversation\ndata: {json.dumps({'id': conversation_id, 'title': new_conv_data['title']})}\n\n"
+            history = []
+        else:
+            history = conversation_history_cache.get(conversation_id, current_user_id, message_count)
+            if history is None:
+                history = await asyncio.to_thread(load_conversation_history, conversation_id, current_user_id)
+            if history is None:
+                yield f"data: {json.dumps('Error: Conversation not found.')}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+    except Exception as e:
+        print(f"Error preparing conversation: {e}")
+        yield f"data: {json.dumps(f'Error: Could not start the conversation. {str(e)}')}\n\n"
+        yield "data: [DONE]\n\n"
+        return
+
+    # ✅ ENHANCED: Build message content with multiple images support
+    message_content = []
+
+    # Add text content
+    if user_message:
+        message_content.append({
+            "type": "text",
+            "text": user_message
+        })
+
+    # Add multiple images content if present
+    message_content.extend(await build_image_parts(images_data, model))
+
+    # Build messages array
+    system_message = {
+        "role": "system",
+        "content": "You are Srushti, an AI trained by Shreyash shastri. Write like a human, Keep your responses professional but conversational. Don't use em dashes or buzzwords. Avoid sounding like a press release, dont use very high level language, keep it natural and also use emojis to keep it friendly, use high level language only when requested by user. Be Clear Direct and natural, like you're writing to a smart friend. Always Use web_search function to find relevant info. Always keep the user engaged, and Please dont write the search results, its just for you to understand, dont mention it in response no matter what. Tell the user only what they have asked; don't introduce additional topics. Keep your answers concise and strictly relevant. "}
+    current_user_message = {"role": "user", "content": message_content if len(message_content) > 1 else user_message}
+    # The count the client sends back next turn; compaction below may drop messages
+    stored_message_count = len(history)
+    # Token counting is CPU work; keep it off the loop the other streams share
+    history = await asyncio.to_thread(compact_history, history, [system_message, current_user_message], model)
+    messages = [
+        system_message,
+        *history,
+        current_user_message
+    ]
+
+    full_ai_response, sources, all_reasoning = "", [], ""
+    buffered_reasoning, tool_calls = "", None
+
+    # ✅ MODIFIED: Only use tools if no images are present (many vision models don't support tools)
+    tools_param = [web_search_tool] if not images_data else []
+
+    final_api_payload = {
+        "model": model,
+        "messages": messages,
+        "stream": True,
+        "tool_choice": "none",
+        "temperature": 0.7,
+        "max_tokens": 2000
+    }
 
-                else:
-                    print("--- Using OpenRouter API for initial call ---")
-                    initial_response = requests.post(
-                        "https://openrouter.ai/api/v1/chat/completions",
-                        headers=headers,
-                        json=final_api_payload,
-                        stream=True,
-                    )
-                    initial_response.raise_for_status()
-                    
-                    for line in initial_response.iter_lines():
-                        if line and line.decode('utf-8').startswith('data: '):
-                            data_str = line.decode('utf-8')[6:]
-                            if data_str == '[DONE]':
-                                break
-                            try:
-                                chunk_data = json.loads(data_str)
-                                if 'choices' not in chunk_data or not chunk_data['choices']:
-                                    continue
-                                chunk = chunk_data['choices'][0]['delta']
-                                
-                                # Handle reasoning content - buffer it, don't stream immediately
-                                # Add this right after handling reasoning in the streaming loop:
-                                if chunk.get('reasoning'):
-                                    reasoning_chunk = chunk.get('reasoning', '')
-                                    buffered_reasoning += reasoning_chunk
-                                    print(f"🧠 Received reasoning chunk: {reasoning_chunk[:100]}...")  # Debug print
-                                    
-                                    # Send reasoning chunk immediately to UI
-                                    yield f"event: reasoning\ndata: {json.dumps(reasoning_chunk)}\n\n"
-                                
-                                # Handle regular content
-                                if chunk.get('content'):
-                                    content = chunk.get('content', '')
-                                    buffered_content += content
-                                    # Stream content immediately if no tool calls are being built
-                                    if not tool_call_chunks:
-                                        yield f"data: {json.dumps(content)}\n\n"
-                                
-                                # Handle tool calls (only if images not present)
-                                if 'tool_calls' in chunk and not images_data:
-                                    for tool_chunk in chunk['tool_calls']:
-                                        index = tool_chunk['index']
-                                        if index not in tool_call_chunks: tool_call_chunks[index] = {}
-                                        if tool_chunk.get('id'): tool_call_chunks[index]['id'] = tool_chunk.get('id')
-                                        if tool_chunk.get('type'): tool_call_chunks[index]['type'] = tool_chunk.get('type')
-                                        if 'function' in tool_chunk:
-                                            if 'function' not in tool_call_chunks[index]: tool_call_chunks[index]['function'] = {}
-                                            if tool_chunk['function'].get('name'): tool_call_chunks[index]['function']['name'] = tool_chunk['function'].get('name')
-                                            if tool_chunk['function'].get('arguments'):
-                                                if 'arguments' not in tool_call_chunks[index]['function']: tool_call_chunks[index]['function']['arguments'] = ""
-                                                tool_call_chunks[index]['function']['arguments'] += tool_chunk['function'].get('arguments')
-                            except (json.JSONDecodeError, KeyError, IndexError) as e:
-                                print(f"Error parsing chunk: {e}")
-                                continue
-                # --- End of conditional API call ---
-                
-                if tool_call_chunks:
-                    tool_calls = list(tool_call_chunks.values())
-                
-                # If we have content but no tool calls, we're done
-                if buffered_content and not tool_calls:
-                    full_ai_response = buffered_content
-
-
-
-            # Handle tool calls (rest of the tool calling logic remains the same...)
-            if tool_calls:
-                # Send buffered reasoning as one complete chunk if we have it
-                if buffered_reasoning:
-                    all_reasoning = buffered_reasoning  # Store for database
-                    yield f"event: reasoning\ndata: {json.dumps(buffered_reasoning)}\n\n"
-                
-                # Execute the tool call
-                arguments_str = tool_calls[0].get('function', {}).get('arguments', '{}')
-                try:
-                    search_query = json.loads(arguments_str).get('query', user_message)
-                except json.JSONDecodeError:
-                    search_query = user_message
-                
-                print(f"--- AI decided to search for: '{search_query}' ---")
-                
-                sources, tool_result_content = perform_web_search(search_query)
-                if sources:
-                    yield f"event: sources\ndata: {json.dumps(sources)}\n\n"
-                
-                # Build the assistant message with tool calls
-                assistant_message = {"role": "assistant", "content": None, "tool_calls": tool_calls}
-                if buffered_reasoning:
-                    assistant_message['reasoning'] = buffered_reasoning
-                
-                # Add messages for tool execution
-                messages.append(assistant_message)
-                messages.append({"role": "tool", "tool_call_id": tool_calls[0]['id'], "content": tool_result_content})
-                
-                # Add explicit instruction for final response
-                messages.append({
-                    "role": "user",
-                    "content": f"Based on the provided web search results, please give a comprehensive answer to my original question: '{user_message}'"
-                })
-
-                # --- MODIFIED: Use Groq or OpenRouter for the final summarization call ---
-                if is_groq_model:
-                    print("--- AI is generating the final response with Groq... ---")
-                    final_response_stream = groq_client.chat.completions.create(
-                        model=model,
-                        messages=messages,
-                        stream=True,
-                        tool_choice="none",
-                        temperature=0.7,
-                        max_tokens=2000
-                    )
-                    for chunk in final_response_stream:
-                        content = chunk.choices[0].delta.content
-                        if content:
-                            full_ai_response += content
-                            yield f"data: {json.dumps(content)}\n\n"
+    # Add tools only if allowed for this turn and not a reasoning model
+    if tools_param and not is_reasoning_model:
+        final_api_payload["tools"] = tools_param
+
+    if is_reasoning_model:
+        if force_thinking:
+            final_api_payload["reasoning"] = {"max_tokens": 2000}
+            print("🧠 Added FORCED reasoning with 2000 tokens")
+        else:
+            final_api_payload["reasoning"] = {"max_tokens": 1000}
+            print("🧠 Added optional reasoning with 1000 tokens")
+        print(f"🧠 Final API payload reasoning: {final_api_payload.get('reasoning')}")
+
+    initial_payloads = {'openrouter': final_api_payload}
+    followup_payloads = {'openrouter': final_api_payload}
+    if 'groq' in model_routes(model):
+        # Either route may answer the first call (hedging, failover), so both offer the same tools
+        if tools_param:
+            initial_payloads['openrouter'] = dict(final_api_payload, tools=tools_param, tool_choice="auto")
+        initial_payloads['groq'] = {"model": model, "messages": messages, "tools": tools_param, "stream": True, "max_tokens": 4096}
+        followup_payloads['groq'] = {
+            "model": model, "messages": messages, "stream": True, "tool_choice": "none", "temperature": 0.7,
+            "max_tokens": 2000,
+        }
+
+    # Start the web search early if the model could end up calling it
+    search_prefetch = None
+    preferred_route = next(name for name in ordered_routes(model) if name in initial_payloads)
+    if SPECULATIVE_SEARCH and user_message and (
+        force_web_search or payload_allows_tool_calls(initial_payloads[preferred_route])
+    ):
+        search_prefetch = asyncio.create_task(perform_web_search(user_message))
+        speculative_search_stats.record('started')
+
+    try:
+        print("--- AI is thinking... (Combined Streaming Step) ---")
+        if force_web_search:
+            print(f"--- Web search was forced by user for: '{user_message}' ---")
+            tool_calls = [{"id": "forced_search", "type": "function", "function": {"name": "web_search", "arguments": json.dumps({"query": user_message})}}]
+        else:
+            initial = CompletionAccumulator(collect_tool_calls=bool(tools_param))
+            async for event in routed_stream(model, initial_payloads):
+                initial.add(event)
+                if isinstance(event, ReasoningEvent):
+                    print(f"🧠 Received reasoning chunk: {event.text[:100]}...")  # Debug print
+                    # Send reasoning chunk immediately to UI
+                    yield SSEDelta(event.text, 'reasoning')
+                elif isinstance(event, ContentEvent) and not initial.has_tool_calls:
+                    # Stream content immediately if no tool calls are being built
+                    yield SSEDelta(event.text)
+
+            buffered_reasoning = initial.reasoning
+            tool_calls = initial.tool_calls()
+
+            # If we have content but no tool calls, we're done
+            if initial.content and not tool_calls:
+                full_ai_response = initial.content
+
+            if search_prefetch and not tool_calls:
+                search_prefetch.cancel()
+                speculative_search_stats.record('unused')
+
+
+
+        # Handle tool calls (rest of the tool calling logic remains the same...)
+        if tool_calls:
+            # Send buffered reasoning as one complete chunk if we have it
+            if buffered_reasoning:
+                all_reasoning = buffered_reasoning  # Store for database
+                yield f"event: reasoning\ndata: {json.dumps(buffered_reasoning)}\n\n"
+
+            # Execute the tool call
+            arguments_str = tool_calls[0].get('function', {}).get('arguments', '{}')
+            try:
+                search_query = json.loads(arguments_str).get('query', user_message)
+            except json.JSONDecodeError:
+                search_query = user_message
+
+            print(f"--- AI decided to search for: '{search_query}' ---")
 
+            if search_prefetch and search_queries_match(user_message, search_query):
+                print("--- Reusing speculative web search result ---")
+                speculative_search_stats.record('forced' if force_web_search else 'hits')
+                sources, tool_result_content = await search_prefetch
+            else:
+                if search_prefetch:
+                    search_prefetch.cancel()
+                    speculative_search_stats.record('misses')
+                sources, tool_result_content = await perform_web_search(search_query)
+            if sources:
+                yield f"event: sources\ndata: {json.dumps(sources)}\n\n"
+
+            # Build the assistant message with tool calls
+            assistant_message = {"role": "assistant", "content": None, "tool_calls": tool_calls}
+            if buffered_reasoning:
+                assistant_message['reasoning'] = buffered_reasoning
+
+            # Image turns offer no tools, so a forced search (which skips the initial call)
+            # is the only way here with images, and they go upstream once, in the follow-up.
+            # Add messages for tool execution
+            messages.append(assistant_message)
+            messages.append({"role": "tool", "tool_call_id": tool_calls[0]['id'], "content": tool_result_content})
+
+            # Add explicit instruction for final response
+            messages.append({
+                "role": "user",
+                "content": f"Based on the provided web search results, please give a comprehensive answer to my original question: '{user_message}'"
+            })
+
+            print("--- AI is generating the final response... ---")
+            final = CompletionAccumulator(collect_tool_calls=False)
+            async for event in routed_stream(model, followup_payloads):
+                final.add(event)
+                if isinstance(event, ReasoningEvent):
+                    print(f"🧠 Final reasoning chunk: {event.text[:50]}...")
+                elif isinstance(event, ContentEvent):
+                    full_ai_response += event.text
+                    yield SSEDelta(event.text)
+
+            if final.reasoning:
+                if all_reasoning:
+                    all_reasoning += "\n\n---\n\n" + final.reasoning
                 else:
-                    print("--- AI is generating the final response with OpenRouter... ---")
-                    final_response = requests.post(
-                        "https://openrouter.ai/api/v1/chat/completions",
-                        headers=headers,
-                        json=final_api_payload,
-                        stream=True,
-                    )
-                    final_response.raise_for_status()
-                    
-                    # Stream the final response (same logic as before...)
-                    final_reasoning_buffer = ""
-                    for line in final_response.iter_lines():
-                        if line:
-                            line_str = line.decode('utf-8')
-                            if line_str.startswith('data: '):
-                                data_str = line_str[6:]
-                                if data_str == '[DONE]':
-                                    if final_reasoning_buffer:
-                                        if all_reasoning: 
-                                            all_reasoning += "\n\n---\n\n" + final_reasoning_buffer
-                                        else: 
-                                            all_reasoning = final_reasoning_buffer
-                                        yield f"event: reasoning\ndata: {json.dumps(final_reasoning_buffer)}\n\n"
-                                        print(f"🧠 Sent final reasoning to UI: {final_reasoning_buffer[:100]}...")
-                                    break
-                                try:
-                                    chunk_data = json.loads(data_str)
-                                    if 'choices' not in chunk_data or not chunk_data['choices']: 
-                                        continue
-                                    delta = chunk_data['choices'][0]['delta']
-                                    content = delta.get('content')
-                                    reasoning = delta.get('reasoning')
-                                    
-                                    if reasoning: 
-                                        final_reasoning_buffer += reasoning
-                                        print(f"🧠 Final reasoning chunk: {reasoning[:50]}...")
-                                    
-                                    if content:
-                                        full_ai_response += content
-                                        yield f"data: {json.dumps(content)}\n\n"
-                                        
-                                except (json.JSONDecodeError, KeyError, IndexError) as e:
-                                    print(f"Error parsing final response chunk: {e}")
-                                    continue
-                # --- End of conditional final call ---
-            
-            yield "data: [DONE]\n\n"
+                    all_reasoning = final.reasoning
+                yield f"event: reasoning\ndata: {json.dumps(final.reasoning)}\n\n"
+                print(f"🧠 Sent final reasoning to UI: {final.reasoning[:100]}...")
+            # --- End of conditional final call ---
+
+        if full_ai_response:
+            # Record the turn before [DONE] so an immediate follow-up message already sees it
+            conversation_history_cache.append(conversation_id, [
+                {"role": "user", "content": user_message or ""},
+                {"role": "assistant", "content": full_ai_response},
+            ])
+
+            # Hand the save to the background queue so the worker is released at [DONE]
+            ai_message_data = {
+                'conversation_id': conversation_id,
+                'sender': 'ai',
+                'content': full_ai_response,
+                'sources': sources or None,
+                'created_at': datetime.now(timezone.utc).isoformat()
+            }
+            if all_reasoning:
+                ai_message_data['reasoning'] = all_reasoning
+            user_message_data = {
+                'conversation_id': conversation_id,
+                'sender': 'user',
+                'content': user_message or '',  # Ensure content is not None
+                'created_at': user_created_at
+            }
+            job = PersistTurnJob(current_user_id, user_message_data, ai_message_data, images_data)
+            if not persistence_queue.submit(job):
+                await asyncio.get_running_loop().run_in_executor(persist_overflow_executor, persistence_queue.run, job)
+            yield f"event: saved\ndata: {json.dumps({'message_count': stored_message_count + 2})}\n\n"
+
+        yield "data: [DONE]\n\n"
+
 
-           
 
+    except Exception as e:
+        print(f"An error occurred in stream: {e}")
+        traceback.print_exc()
+        yield f"data: {json.dumps(f'An error occurred: {str(e)}')}\n\n"
+        yield "data: [DONE]\n\n"
+        return
+    finally:
+        if search_prefetch and not search_prefetch.done():
+            search_prefetch.cancel()
+
+
+
+# --- Resumable Generations ---
+# Each chat turn runs as a detached job on an event loop and writes its SSE frames,
+# numbered with `id:` lines, into a bounded ring buffer. Clients only subscribe: if
+# the connection drops, reconnecting with Last-Event-ID replays the missed frames and
+# follows the live ones without a new upstream call. Jobs live in this process, so
+# with several workers the resume has to reach the same one (sticky sessions).
+GENERATION_BUFFER_FRAMES = int(os.getenv("GENERATION_BUFFER_FRAMES", "2048"))
+GENERATION_RETENTION = int(os.getenv("GENERATION_RETENTION", "300"))  # seconds a finished job stays resumable
+GENERATION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+class GenerationJob:
+    """One chat turn running independently of the connection that started it."""
+
+    def __init__(self, user_id, loop, capacity):
+        self.id = secrets.token_urlsafe(16)
+        self.user_id = user_id
+        self.loop = loop
+        self.frames = deque(maxlen=capacity)
+        self.next_id = 0
+        self.finished_at = None
+        self.future = None
+        self._waiters = []
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def can_resume(self, last_event_id):
+        """True if every frame after `last_event_id` is still buffered."""
+        return last_event_id + 1 >= self.next_id - len(self.frames)
+
+    def _append(self, frame):
+        self.frames.append(f"id: {self.next_id}\n{frame}")
+        self.next_id += 1
+        self._notify()
+
+    def _notify(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def run(self, agen):
+        done = False
+        try:
+            async for frame in agen:
+                self._append(frame)
+                done = frame.endswith("data: [DONE]\n\n")
+        except asyncio.CancelledError:
+            print(f"Generation {self.id} was cancelled")
         except Exception as e:
-            print(f"An error occurred in stream: {e}")
+            print(f"Error in generation {self.id}: {e}")
             traceback.print_exc()
-            yield f"data: {json.dumps(f'An error occurred: {str(e)}')}\n\n"
-            yield "data: [DONE]\n\n"
+            self._append(f"data: {json.dumps(f'An error occurred: {str(e)}')}\n\n")
+        finally:
+            await agen.aclose()
+            # Every job ends with [DONE], so clients never mistake a failed turn for a dropped connection
+            if not done:
+                self._append("data: [DONE]\n\n")
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    async def subscribe(self, last_event_id=-1):
+        """Yields the frames after `last_event_id`, then live ones until the job finishes."""
+        next_id = last_event_id + 1
+        while True:
+            # Recomputed per frame: the buffer may have moved on while we were suspended
+            first_id = self.next_id - len(self.frames)
+            if next_id < first_id:
+                print(f"Subscriber of generation {self.id} fell behind the replay buffer")
+                return
+            if next_id < self.next_id:
+                yield self.frames[next_id - first_id]
+                next_id += 1
+                continue
+            if self.finished:
+                return
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
+
+class GenerationRegistry:
+    """Running and recently finished generation jobs, by id."""
+
+    def __init__(self, capacity, retention):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._retention = retention
+        self._jobs = {}
+        self.started = 0
+        self.resumed = 0
+        self.cancelled = 0
+        self.expired = 0
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for generation_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished_at > self._retention:
+                del self._jobs[generation_id]
+                self.expired += 1
+
+    def start(self, user_id, agen, loop):
+        """Starts `agen` as a detached job on `loop` (from any thread) and returns the job."""
+        job = GenerationJob(user_id, loop, self._capacity)
+        with self._lock:
+            self._evict_expired()
+            self._jobs[job.id] = job
+            self.started += 1
+        job.future = asyncio.run_coroutine_threadsafe(job.run(agen), loop)
+        return job
+
+    def get(self, generation_id, user_id):
+        with self._lock:
+            self._evict_expired()
+            job = self._jobs.get(generation_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if not job.finished)
+            return {
+                'running': running,
+                'retained': len(self._jobs) - running,
+                'started': self.started,
+                'resumed': self.resumed,
+                'cancelled': self.cancelled,
+                'expired': self.expired,
+                'buffer_frames': self._capacity,
+            }
+
+
+generation_jobs = GenerationRegistry(GENERATION_BUFFER_FRAMES, GENERATION_RETENTION)
+
+
+def sse_response(job, last_event_id=-1):
+    response = Response(iter_async_stream(job.subscribe(last_event_id), loop=job.loop), mimetype='text/event-stream')
+    response.headers['X-Generation-Id'] = job.id
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# ✅ ENHANCED: Chat route with multi-image support
+@app.route('/chat', methods=['POST'])
+@login_required
+def chat():
+    chat_data = request.json
+    user_id = session['user']['id']
+    job = generation_jobs.start(user_id, stream_chat(chat_data, user_id), get_stream_loop())
+    return sse_response(job)
+
+
+@app.route('/chat/<generation_id>/events')
+@login_required
+def resume_chat(generation_id):
+    if not GENERATION_ID_PATTERN.match(generation_id):
+        return jsonify({'error': 'Invalid generation id'}), 400
+    job = generation_jobs.get(generation_id, session['user']['id'])
+    if job is None:
+        return jsonify({'error': 'Generation not found'}), 404
+
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', request.args.get('last_event_id', '-1')))
+    except ValueError:
+        return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+    if not job.can_resume(last_event_id):
+        return jsonify({'error': 'Generation is no longer buffered'}), 410
+
+    generation_jobs.record('resumed')
+    return sse_response(job, last_event_id)
+
+
+@app.route('/chat/<generation_id>/cancel', methods=['POST'])
+@login_required
+def cancel_chat(generation_id):
+    if not GENERATION_ID_PATTERN.match(generation_id):
+        return jsonify({'error': 'Invalid generation id'}), 400
+    job = generation_jobs.get(generation_id, session['user']['id'])
+    if job is None:
+        return jsonify({'error': 'Generation not found'}), 404
+    if not job.finished:
+        job.cancel()
+        generation_jobs.record('cancelled')
+    return jsonify({'success': True})
+
+
+
+# --- Metrics ---
+@app.route('/metrics')
+@login_required
+def metrics():
+    return jsonify({
+        'upstream_pool': upstream_pool_metrics.snapshot(),
+        'speculative_search': speculative_search_stats.snapshot(),
+        'search_cache': search_cache.snapshot(),
+        'conversation_history_cache': conversation_history_cache.snapshot(),
+        'conversation_list': conversation_list_loader.snapshot(),
+        'persistence_queue': persistence_queue.snapshot(),
+        'stored_images': stored_image_stats.snapshot(),
+        'sse_coalescing': sse_coalescing_stats.snapshot(),
+        'routes': route_stats.snapshot(),
+        'generations': generation_jobs.snapshot(),
+    })
+
+
+
+# --- ASGI Entry Point ---
+# Serve with e.g. `gunicorn -k uvicorn.workers.UvicornWorker app:asgi_app`.
+# /chat is handled natively on the event loop; every other route goes to Flask.
+
+flask_asgi = WsgiToAsgi(app)
+
+
+async def send_json_error(send, status, message):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps({'error': message}).encode()})
+
+
+async def asgi_chat(scope, receive, send):
+    # Reuse Flask's cookie session for auth, from the headers alone, before reading any body
+    headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']]
+    environ = EnvironBuilder(path=scope['path'], method=scope['method'], headers=headers).get_environ()
+    with app.request_context(environ):
+        user = session.get('user')
+        login_url = url_for('login')
+
+    if not user:
+        await send({'type': 'http.response.start', 'status': 302, 'headers': [(b'location', login_url.encode())]})
+        await send({'type': 'http.response.body', 'body': b""})
+        return
+
+    # MAX_CONTENT_LENGTH isn't enforced by Flask on this path, so apply it while reading.
+    # EnvironBuilder drops Content-Length without a body, so it is read from the scope.
+    max_length = app.config['MAX_CONTENT_LENGTH']
+    content_length = next((value for name, value in headers if name.lower() == 'content-length'), '')
+    if content_length.strip().isdigit() and int(content_length) > max_length:
+        await send_json_error(send, 413, 'Request body too large')
+        return
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
             return
-        
-        # ✅ FIXED: Save the conversation to database with proper multi-image support
-        try:
-            if full_ai_response:
-                ai_message_data = {
-                    'conversation_id': conversation_id,
-                    'sender': 'ai',
-                    'content': full_ai_response,
-                    'sources': sources or None
-                }
-                
-                # ✅ FIXED: Save user message with multiple images support
-                user_message_data = {
-                    'conversation_id': conversation_id,
-                    'sender': 'user',
-                    'content': user_message or ''  # Ensure content is not None
-                }
-                
-                # ✅ FIXED: Store multiple images properly
-                if images_data:
-                    user_message_data['has_image'] = True
-                    urls_for_db = []
-
-                    for img_data in images_data:
-                        try:
-                            # Decode base64 back to bytes
-                            img_bytes = base64.b64decode(img_data['image_data'])
-                            filename = f"{current_user_id}/{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{secure_filename(img_data['filename'])}"
-
-                            # Upload to Supabase Storage
-                            storage_res = supabase.storage.from_("chat-images").upload(
-                                filename,
-                                img_bytes,
-                                {"content-type": img_data['mime_type']}
-                            )
-
-                            # Get public URL
-                            public_url = supabase.storage.from_("chat-images").get_public_url(filename)
-                            urls_for_db.append(public_url)
-
-                        except Exception as e:
-                            print(f"Error uploading image: {e}")
-                            continue
-
-                    user_message_data['image_urls'] = urls_for_db
-                
-                # Add reasoning to the AI message if we have it
-                if all_reasoning:
-                    ai_message_data['reasoning'] = all_reasoning
-                
-                # Insert both messages
-                supabase.table('messages').insert([
-                    user_message_data,
-                    ai_message_data
-                ]).execute()
-                print("--- Conversation saved successfully. ---")
-        
-        except Exception as e:
-            print(f"Error saving conversation to database: {e}")
-            traceback.print_exc()  # This will help debug the exact error
+        body += message.get('body', b"")
+        if len(body) > max_length:
+            await send_json_error(send, 413, 'Request body too large')
+            return
+        if not message.get('more_body'):
+            break
+
+    try:
+        chat_data = json.loads(body) if body else {}
+    except ValueError:
+        chat_data = {}
+    if not isinstance(chat_data, dict):
+        chat_data = {}
+
+    # The turn runs detached on this loop; a dropped connection only ends the subscription
+    job = generation_jobs.start(user['id'], stream_chat(chat_data, user['id']), asyncio.get_running_loop())
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+            (b'x-generation-id', job.id.encode()),
+        ],
+    })
 
-    return Response(stream(chat_data, user_id), mimetype='text/event-stream')
+    async def pump():
+        async for frame in job.subscribe():
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    pump_task = asyncio.create_task(pump())
+    disconnect_task = asyncio.create_task(wait_for_disconnect())
+    await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    disconnect_task.cancel()
+    if not pump_task.done():
+        pump_task.cancel()
+        return
+    await send({'type': 'http.response.body', 'body': b"", 'more_body': False})
+
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == '/chat' and scope['method'] == 'POST':
+        await asgi_chat(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
 
 
 
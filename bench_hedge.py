@@ -0,0 +1,70 @@
+"""Time-to-first-token with and without hedged requests, on simulated providers.
+
+Two fake providers serve the same model. Each first token takes a log-normal time
+(median MEDIAN_MS) and SLOW_SHARE of requests hit a stall of STALL_MS, like a cold
+or overloaded upstream. COMPLETIONS turns are streamed through app.routed_stream:
+
+  before: HEDGE_REQUESTS off (primary route only)
+  after:  HEDGE_REQUESTS on (hedge on the alternate route at the primary's p95)
+
+Reports TTFT percentiles and how many extra upstream requests hedging cost.
+
+Usage: python bench_hedge.py [completions] [slow_share]
+"""
+import asyncio
+import random
+import sys
+import time
+
+import app
+
+COMPLETIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+SLOW_SHARE = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+MEDIAN_MS = 250
+STALL_MS = 4000
+MODEL = "bench/model"
+
+
+class SimulatedProvider:
+    def __init__(self, name, seed):
+        self.name = self.label = name
+        self.rng = random.Random(seed)
+
+    async def stream(self, payload):
+        delay = MEDIAN_MS / 1000 * self.rng.lognormvariate(0, 0.35)
+        if self.rng.random() < SLOW_SHARE:
+            delay += STALL_MS / 1000
+        await asyncio.sleep(delay)
+        yield app.ContentEvent("Hello")
+        yield app.DoneEvent("stop")
+
+
+async def first_token_ms():
+    started = time.perf_counter()
+    async for _ in app.routed_stream(MODEL, {'primary': {}, 'alternate': {}}):
+        return (time.perf_counter() - started) * 1000
+
+
+async def run(hedge):
+    app.HEDGE_REQUESTS = hedge
+    app.route_stats = app.RouteStats(app.ROUTE_TTFT_WINDOW)
+    app.CHAT_PROVIDERS.update(primary=SimulatedProvider('primary', 1), alternate=SimulatedProvider('alternate', 2))
+    samples = []
+    # A few at a time so the route percentiles warm up as they would in production
+    for start in range(0, COMPLETIONS, 10):
+        samples += await asyncio.gather(*(first_token_ms() for _ in range(min(10, COMPLETIONS - start))))
+    routes = app.route_stats.snapshot()
+    requests = sum(route['requests'] for route in routes.values())
+    return sorted(samples), requests
+
+
+if __name__ == '__main__':
+    app.print = lambda *args, **kwargs: None  # keep per-request routing logs out of the report
+    app.MODEL_ROUTES[MODEL] = ['primary', 'alternate']
+    print(f"{COMPLETIONS} completions, median first token {MEDIAN_MS} ms, "
+          f"{SLOW_SHARE:.0%} stall for +{STALL_MS} ms\n")
+    for label, hedge in (("before (no hedging)", False), ("after (hedged at p95)", True)):
+        samples, requests = asyncio.run(run(hedge))
+        p50, p95, p99 = (app.percentile(samples, pct) for pct in (50, 95, 99))
+        print(f"{label:22} TTFT p50 {p50:6.0f} ms  p95 {p95:6.0f} ms  p99 {p99:6.0f} ms  "
+              f"max {samples[-1]:6.0f} ms  upstream requests +{(requests / COMPLETIONS - 1):.1%}")
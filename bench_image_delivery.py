@@ -0,0 +1,114 @@
+"""Upstream request size and time-to-first-token, inline base64 vs signed image URLs.
+
+A local fake OpenRouter reads the request body at UPLINK_MBPS (app server to the
+provider) and answers with its first token as soon as the body has arrived. For
+signed URLs, storage uploads go through a fake Supabase bucket at STORAGE_MBPS
+(app server to storage, usually in-region) before the completion starts, so their
+cost is counted in TTFT.
+
+  inline: app.build_image_parts with IMAGE_URL_DELIVERY off (data: URLs)
+  signed: app.build_image_parts with IMAGE_URL_DELIVERY on
+
+Usage: python bench_image_delivery.py [uplink_mbps] [storage_mbps]
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from PIL import Image
+
+import app
+
+UPLINK_MBPS = float(sys.argv[1]) if len(sys.argv) > 1 else 20
+STORAGE_MBPS = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+MODEL = "mistralai/mistral-small-3.2-24b-instruct:free"
+
+received = []
+
+
+async def fake_openrouter(reader, writer):
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    remaining = length
+    while remaining:
+        chunk = await reader.read(min(remaining, 64 * 1024))
+        remaining -= len(chunk)
+        await asyncio.sleep(len(chunk) * 8 / (UPLINK_MBPS * 1e6))
+    received.append(length)
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+    writer.write(f"data: {json.dumps({'choices': [{'delta': {'content': 'Hi'}}]})}\n\n".encode())
+    writer.write(b"data: [DONE]\n\n")
+    await writer.drain()
+    writer.close()
+
+
+def start_fake_server():
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(fake_openrouter, "127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/api/v1/chat/completions"
+
+
+class FakeBucket:
+    def upload(self, path, data, options):
+        time.sleep(len(data) * 8 / (STORAGE_MBPS * 1e6))
+
+    def create_signed_url(self, path, expires_in):
+        return {'signedURL': f"https://project.supabase.co/storage/v1/object/sign/chat-images/{path}?token=" + "x" * 180}
+
+
+class FakeQuery:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        return type('Result', (), {'data': []})()
+
+
+class FakeSupabase:
+    class storage:
+        @staticmethod
+        def from_(bucket):
+            return FakeBucket()
+
+    def table(self, name):
+        return FakeQuery()
+
+
+def make_photo(seed, size=(4032, 3024)):
+    small = (size[0] // 8, size[1] // 8)
+    img = Image.frombytes('RGB', small, os.urandom(small[0] * small[1] * 3)).resize(size, Image.Resampling.BILINEAR)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=90)
+    data, mime_type = app.resize_image_if_needed(output.getvalue(), output_format='WEBP')
+    return {'data': data, 'mime_type': mime_type, 'filename': f'{seed}.webp',
+            'hash': hashlib.sha256(data).hexdigest()}
+
+
+async def first_token_ms(images_data):
+    started = time.perf_counter()
+    content = [{"type": "text", "text": "What is in these pictures?"}, *await app.build_image_parts(images_data, MODEL)]
+    payload = {"model": MODEL, "messages": [{"role": "user", "content": content}], "stream": True}
+    async for _ in app.stream_openrouter(payload, {}):
+        return (time.perf_counter() - started) * 1000
+
+
+if __name__ == '__main__':
+    app.OPENROUTER_CHAT_URL = start_fake_server()
+    app.supabase = FakeSupabase()
+    print(f"uplink {UPLINK_MBPS:g} Mbit/s, storage {STORAGE_MBPS:g} Mbit/s\n")
+    for count in (1, 4):
+        images = [make_photo(i) for i in range(count)]
+        for label, enabled in (("inline", False), ("signed", True)):
+            app.IMAGE_URL_DELIVERY = enabled
+            # Fresh dicts so signed runs don't reuse paths remembered by a previous run
+            ttft = asyncio.run(first_token_ms([dict(img) for img in images]))
+            print(f"{count:2d} image(s) {label:6}  request body {received[-1] / 1024:8.1f} KiB  TTFT {ttft:7.1f} ms")
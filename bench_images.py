@@ -0,0 +1,98 @@
+"""Image round-trip cost, before vs after content-addressed upload handles.
+
+For each image: /upload_images resizes it, then /chat is sent referencing it.
+
+  before: upload response carries the base64 bytes, the browser posts them back in
+          images_data and the server decodes them again for storage
+  after:  upload stores the bytes under their SHA-256 and returns a handle, /chat
+          posts the handle and the server reads the bytes back from the store
+
+Resizing is identical in both and excluded. Reports bytes on the wire (upload
+response + chat request) and server CPU time for the work that differs.
+
+Usage: python bench_images.py [images] [rounds]
+"""
+import base64
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import app
+
+IMAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+
+def make_photo(seed, size=(3000, 2000)):
+    # Noise compresses like a real photo, unlike a flat colour
+    img = Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)).resize((size[0] // 4, size[1] // 4))
+    img = img.resize(size, Image.Resampling.BILINEAR)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def cpu_ms(fn):
+    started = time.process_time()
+    for _ in range(ROUNDS):
+        result = fn()
+    return (time.process_time() - started) * 1000 / ROUNDS, result
+
+
+def run_before(resized):
+    def upload():
+        return json.dumps({'success': True, 'images': [
+            {'image_data': base64.b64encode(data).decode('utf-8'), 'mime_type': 'image/jpeg', 'filename': f'{i}.jpg'}
+            for i, data in enumerate(resized)
+        ]})
+
+    upload_ms, upload_body = cpu_ms(upload)
+    images = json.loads(upload_body)['images']
+    chat_body = json.dumps({'message': 'What is in these pictures?', 'images_data': images})
+
+    def chat():
+        images_data = json.loads(chat_body)['images_data']
+        # Upstream reuses the posted base64; storage needs the raw bytes
+        return [base64.b64decode(img['image_data']) for img in images_data]
+
+    chat_ms, _ = cpu_ms(chat)
+    return len(upload_body), len(chat_body), upload_ms + chat_ms
+
+
+def run_after(resized):
+    def upload():
+        # Fresh store each round so every upload pays for the write
+        app.image_store = app.ImageStore(tempfile.mkdtemp(prefix='bench-image-store-'))
+        return json.dumps({'success': True, 'images': [
+            {'handle': app.image_store.put(data, 'image/jpeg'), 'url': '/images/x', 'mime_type': 'image/jpeg',
+             'filename': f'{i}.jpg'}
+            for i, data in enumerate(resized)
+        ]})
+
+    upload_ms, upload_body = cpu_ms(upload)
+    images = json.loads(upload_body)['images']
+    chat_body = json.dumps({'message': 'What is in these pictures?', 'images_data': [
+        {'handle': img['handle'], 'filename': img['filename']} for img in images
+    ]})
+
+    def chat():
+        images_data = app.resolve_chat_images(json.loads(chat_body)['images_data'])
+        # Upstream still needs a data: URL built once server-side
+        return [base64.b64encode(img['data']) for img in images_data]
+
+    chat_ms, _ = cpu_ms(chat)
+    return len(upload_body), len(chat_body), upload_ms + chat_ms
+
+
+if __name__ == '__main__':
+    resized = [app.resize_image_if_needed(make_photo(i))[0] for i in range(IMAGES)]
+    print(f"{IMAGES} images, {sum(map(len, resized)) / 1024:.0f} KiB after resize, {ROUNDS} rounds\n")
+    for label, runner in (("before (base64 round trip)", run_before), ("after (handles)", run_after)):
+        upload_bytes, chat_bytes, server_ms = runner(resized)
+        print(f"{label:28} upload response {upload_bytes / 1024:8.1f} KiB  chat request {chat_bytes / 1024:8.1f} KiB  "
+              f"server CPU {server_ms:6.2f} ms")
@@ -0,0 +1,105 @@
+"""resize_image_if_needed cost per photo, before vs after draft-mode decoding.
+
+  before: full-resolution decode, LANCZOS thumbnail, JPEG encode at 85 and again
+          at 60 if the first pass was over the size limit
+  after:  app.resize_image_if_needed (draft-mode JPEG decode, pass-through for
+          images already within limits, quality picked before encoding)
+  webp:   the same, encoding WebP as for models that accept it
+
+Each variant runs in its own subprocess so peak RSS is measured separately.
+Point it at a directory of phone-camera photos; without one it generates a
+synthetic corpus of 12MP photos plus a few already-small images.
+
+Usage: python bench_resize.py [photo_dir]
+"""
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def legacy_resize(image_data, max_size=(1024, 1024), max_file_size_mb=5):
+    img = Image.open(io.BytesIO(image_data))
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=85, optimize=True)
+    resized_data = output.getvalue()
+    if len(resized_data) > max_file_size_mb * 1024 * 1024:
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=60, optimize=True)
+        resized_data = output.getvalue()
+    return resized_data
+
+
+def synthetic_photo(size, quality=92, seed=0):
+    # Smooth gradients and shapes with a little sensor-like grain: closer to a real
+    # photo than pure noise, which no codec compresses well
+    rng = random.Random(seed)
+    small = (size[0] // 4, size[1] // 4)
+    img = Image.new('RGB', small)
+    draw = ImageDraw.Draw(img)
+    for y in range(small[1]):
+        draw.line([(0, y), (small[0], y)], fill=(y * 255 // small[1], 120, 255 - y * 200 // small[1]))
+    for _ in range(60):
+        x, y, r = rng.randrange(small[0]), rng.randrange(small[1]), rng.randrange(10, small[0] // 4)
+        draw.ellipse([x, y, x + r, y + r], fill=tuple(rng.randrange(256) for _ in range(3)))
+    img = img.filter(ImageFilter.GaussianBlur(2)).resize(size, Image.Resampling.BICUBIC)
+    grain = Image.frombytes('L', size, os.urandom(size[0] * size[1]))
+    img = Image.blend(img, Image.merge('RGB', (grain, grain, grain)), 0.05)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def write_synthetic_corpus():
+    photo_dir = tempfile.mkdtemp(prefix='bench-resize-')
+    sizes = [(4032, 3024), (3024, 4032), (4000, 3000), (4624, 3472)] * 3 + [(1024, 768), (800, 600)] * 2
+    for i, size in enumerate(sizes):
+        with open(os.path.join(photo_dir, f'{i:02d}.jpg'), 'wb') as f:
+            f.write(synthetic_photo(size, seed=i))
+    return photo_dir
+
+
+def load_corpus(photo_dir):
+    return [open(os.path.join(photo_dir, name), 'rb').read() for name in sorted(os.listdir(photo_dir))
+            if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
+
+
+def run_variant(variant, photo_dir):
+    import app  # imported in both variants so the baseline RSS matches
+    if variant == 'before':
+        resize = legacy_resize
+    else:
+        output_format = 'WEBP' if variant == 'webp' else 'JPEG'
+        resize = lambda data: app.resize_image_if_needed(data, output_format=output_format)[0]
+    corpus = load_corpus(photo_dir)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    output_bytes = sum(len(resize(data)) for data in corpus)
+    elapsed = time.perf_counter() - started
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{variant:7} {len(corpus):3d} photos  {elapsed * 1000 / len(corpus):7.1f} ms/image  "
+          f"peak RSS {peak_kb / 1024:6.1f} MiB (+{(peak_kb - baseline_kb) / 1024:5.1f} MiB while resizing)  "
+          f"output {output_bytes / len(corpus) / 1024:6.1f} KiB/image")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--variant':
+        run_variant(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) > 1 and sys.argv[1] == '--write-corpus':
+        print(write_synthetic_corpus())
+    else:
+        # ru_maxrss survives fork+exec, so the corpus is generated in its own process too
+        photo_dir = sys.argv[1] if len(sys.argv) > 1 else subprocess.run(
+            [sys.executable, __file__, '--write-corpus'], check=True, capture_output=True, text=True
+        ).stdout.strip()
+        for variant in ('before', 'after', 'webp'):
+            subprocess.run([sys.executable, __file__, '--variant', variant, photo_dir], check=True)
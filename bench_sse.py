@@ -0,0 +1,98 @@
+"""/chat frames and server CPU per response, one frame per delta vs coalesced frames.
+
+A fake OpenRouter in a separate process streams DELTAS small deltas (1-3 tokens,
+~8 ms apart with jitter) per completion. RESPONSES completions run at once through
+the OpenRouter provider -> app.coalesce_sse -> app.iter_async_stream, the same path
+the WSGI /chat route takes, and every frame is encoded as it would be for the socket.
+
+  before: SSE_FLUSH_INTERVAL_MS=0 (a frame per upstream delta)
+  after:  SSE_FLUSH_INTERVAL_MS / SSE_FLUSH_BYTES defaults
+
+CPU time is this process only (the fake provider runs elsewhere).
+
+Usage: python bench_sse.py [responses] [deltas]
+"""
+import asyncio
+import json
+import multiprocessing
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+RESPONSES = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+DELTAS = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+WORDS = "the quick brown fox jumps over a lazy dog while streaming tokens arrive".split()
+
+
+def run_fake_openrouter(port_queue):
+    async def handle(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        await reader.readexactly(length)
+        rng = random.Random(length)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        for _ in range(DELTAS):
+            text = "".join(rng.choice(WORDS) + " " for _ in range(rng.randint(1, 3)))
+            writer.write(f"data: {json.dumps({'choices': [{'delta': {'content': text}}]})}\n\n".encode())
+            await writer.drain()
+            await asyncio.sleep(rng.uniform(0.002, 0.014))
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0, backlog=1024)
+        port_queue.put(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+async def turn_events():
+    async for event in app.CHAT_PROVIDERS['openrouter'].stream({"messages": []}):
+        if isinstance(event, app.ContentEvent):
+            yield app.SSEDelta(event.text)
+    yield "data: [DONE]\n\n"
+
+
+def consume(interval_ms):
+    started = time.perf_counter()
+    frames, first_frame_ms, size = 0, None, 0
+    for frame in app.iter_async_stream(app.coalesce_sse(turn_events(), interval_ms=interval_ms)):
+        size += len(frame.encode('utf-8'))
+        frames += 1
+        if first_frame_ms is None:
+            first_frame_ms = (time.perf_counter() - started) * 1000
+    return frames, first_frame_ms, size
+
+
+def run(interval_ms):
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=RESPONSES) as pool:
+        results = list(pool.map(consume, [interval_ms] * RESPONSES))
+    cpu_ms = (time.process_time() - cpu_started) * 1000
+    wall = time.perf_counter() - wall_started
+    frames = sum(r[0] for r in results) / RESPONSES
+    first_ms = sum(r[1] for r in results) / RESPONSES
+    kib = sum(r[2] for r in results) / RESPONSES / 1024
+    return frames, kib, cpu_ms / RESPONSES, first_ms, wall
+
+
+if __name__ == '__main__':
+    ports = multiprocessing.Queue()
+    multiprocessing.Process(target=run_fake_openrouter, args=(ports,), daemon=True).start()
+    app.OPENROUTER_CHAT_URL = f"http://127.0.0.1:{ports.get()}/api/v1/chat/completions"
+    run(0)  # warm up the pool and loop
+
+    print(f"{RESPONSES} concurrent responses, {DELTAS} upstream deltas each\n")
+    for label, interval_ms in (("before (frame per delta)", 0), (f"after ({app.SSE_FLUSH_INTERVAL_MS:g} ms / "
+                                                                 f"{app.SSE_FLUSH_BYTES} B)", None)):
+        frames, kib, cpu_ms, first_ms, wall = run(interval_ms)
+        print(f"{label:28} frames/response {frames:7.1f} ({kib:5.1f} KiB)  server CPU/response {cpu_ms:6.2f} ms  "
+              f"first frame {first_ms:6.1f} ms  wall {wall:5.2f}s")
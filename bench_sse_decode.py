@@ -0,0 +1,128 @@
+"""Upstream SSE decode cost per completion, replaying recorded OpenRouter streams.
+
+Streams are fed in network-sized pieces (one per event for the synthesized ones,
+4 KiB for recordings, or --split BYTES) through:
+
+  before:  text line splitting (httpx aiter_lines) + json.loads + dict lookups
+  jiter:   the same line handling with jiter.from_json
+  after:   app.UpstreamSSEDecoder (bytes, msgspec typed structs)
+
+Pass recorded streams (raw response bodies, e.g. `curl -N ... > reply.sse`) as
+arguments; without any, a content stream, a reasoning stream and a tool-call stream
+in OpenRouter's chunk shape are synthesized.
+
+Usage: python bench_sse_decode.py [--split BYTES] [recording.sse ...]
+"""
+import json
+import random
+import sys
+import time
+
+import jiter
+from httpx._decoders import LineDecoder, TextDecoder
+
+import app
+
+ROUNDS = 200
+
+
+def chunk_event(delta, finish_reason=None):
+    return "data: " + json.dumps({
+        "id": "gen-1760000000-AbCdEfGhIjKlMnOpQrSt", "provider": "Chutes", "model": "openai/gpt-oss-120b",
+        "object": "chat.completion.chunk", "created": 1760000000,
+        "choices": [{"index": 0, "delta": {"role": "assistant", **delta}, "finish_reason": finish_reason,
+                     "native_finish_reason": finish_reason, "logprobs": None}],
+    }) + "\n\n"
+
+
+def synthesize():
+    rng = random.Random(7)
+    words = "the model streams a few tokens per chunk while answering the question in markdown".split()
+
+    def text():
+        return "".join(rng.choice(words) + " " for _ in range(rng.randint(1, 3)))
+
+    usage = "data: " + json.dumps({"choices": [], "usage": {"prompt_tokens": 812, "completion_tokens": 640}}) + "\n\n"
+    content = [": OPENROUTER PROCESSING\n\n"] + [chunk_event({"content": text()}) for _ in range(600)]
+    reasoning = [chunk_event({"content": "", "reasoning": text(), "reasoning_details": [
+        {"type": "reasoning.text", "text": "...", "format": "unknown", "index": 0}]}) for _ in range(400)]
+    reasoning += [chunk_event({"content": text()}) for _ in range(300)]
+    arguments = json.dumps({"query": "latest news about the topic"})
+    tool = [chunk_event({"content": None, "tool_calls": [{"index": 0, "id": "call_1", "type": "function",
+                                                          "function": {"name": "web_search", "arguments": ""}}]})]
+    tool += [chunk_event({"content": None, "tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + 4]}}]})
+             for i in range(0, len(arguments), 4)]
+    end = [chunk_event({"content": ""}, "stop"), usage, "data: [DONE]\n\n"]
+    return {
+        "content (600 chunks)": [e.encode() for e in content + end],
+        "reasoning (700 chunks)": [e.encode() for e in reasoning + end],
+        "tool call": [e.encode() for e in tool + end],
+    }
+
+
+def split(pieces, size):
+    raw = b"".join(pieces)
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def decode_lines(pieces, loads):
+    text_decoder, line_decoder = TextDecoder(), LineDecoder()
+    deltas = []
+    for piece in pieces:
+        for line in line_decoder.decode(text_decoder.decode(piece)):
+            if not line.startswith('data: '):
+                continue
+            data_str = line[6:]
+            if data_str == '[DONE]':
+                return deltas
+            chunk_data = loads(data_str)
+            if 'choices' not in chunk_data or not chunk_data['choices']:
+                continue
+            delta = chunk_data['choices'][0]['delta']
+            deltas.append((delta.get('content'), delta.get('reasoning'), delta.get('tool_calls')))
+    return deltas
+
+
+def before(pieces):
+    return decode_lines(pieces, json.loads)
+
+
+def with_jiter(pieces):
+    return decode_lines(pieces, lambda s: jiter.from_json(s.encode()))
+
+
+def after(pieces):
+    decoder, deltas = app.UpstreamSSEDecoder(), []
+    for piece in pieces:
+        for choice in decoder.feed(piece):
+            deltas.append((choice.delta.content, choice.delta.reasoning, choice.delta.tool_calls))
+        if decoder.done:
+            break
+    return deltas
+
+
+def per_completion_us(decode, pieces):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        decode(pieces)
+    return (time.perf_counter() - started) * 1e6 / ROUNDS
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    split_size = None
+    if args[:1] == ['--split']:
+        split_size, args = int(args[1]), args[2:]
+    streams = {path: [open(path, 'rb').read()] for path in args} if args else synthesize()
+
+    for name, pieces in streams.items():
+        if split_size or args:
+            pieces = split(pieces, split_size or 4096)
+        assert len(before(pieces)) == len(after(pieces)), "decoders disagree on the number of deltas"
+        size = sum(map(len, pieces)) / 1024
+        print(f"{name}: {len(after(pieces))} deltas, {size:.0f} KiB in {len(pieces)} pieces")
+        base = None
+        for label, decode in (("before (json.loads)", before), ("jiter", with_jiter), ("after (msgspec)", after)):
+            us = per_completion_us(decode, pieces)
+            base = base or us
+            print(f"  {label:22} {us / 1000:7.2f} ms/completion  {base / us:5.2f}x")
@@ -0,0 +1,106 @@
+"""Concurrent /chat upstream stream capacity, before vs after the async engine.
+
+Starts a local fake OpenRouter that streams SSE chunks slowly, then opens N
+completions against it:
+
+  before: blocking requests.post(stream=True) on a fixed pool of worker threads
+          (what a gthread gunicorn worker could do)
+  after:  app.stream_openrouter on one event loop over the shared AsyncClient
+
+Usage: python bench_stream.py [streams] [worker_threads]
+"""
+import asyncio
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import app
+
+STREAMS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+WORKER_THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+CHUNKS = 20
+CHUNK_DELAY = 0.05  # ~1s per completion
+
+stats = {'open': 0, 'peak': 0}
+
+
+async def fake_openrouter(reader, writer):
+    # Drain the request (headers + JSON body)
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    await reader.readexactly(length)
+
+    stats['open'] += 1
+    stats['peak'] = max(stats['peak'], stats['open'])
+    try:
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        for i in range(CHUNKS):
+            chunk = {"choices": [{"delta": {"content": f"tok{i} "}}]}
+            writer.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+            await asyncio.sleep(CHUNK_DELAY)
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+    finally:
+        stats['open'] -= 1
+        writer.close()
+
+
+def start_fake_server():
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(fake_openrouter, "127.0.0.1", 0, backlog=4096))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/api/v1/chat/completions"
+
+
+def blocking_stream(url):
+    response = requests.post(url, json={"messages": []}, stream=True)
+    tokens = 0
+    for line in response.iter_lines():
+        if line and line.decode('utf-8').startswith('data: ') and line.decode('utf-8')[6:] != '[DONE]':
+            tokens += 1
+    return tokens
+
+
+def run_before(url):
+    stats['peak'] = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as pool:
+        list(pool.map(blocking_stream, [url] * STREAMS))
+    return time.perf_counter() - started, stats['peak']
+
+
+async def async_stream():
+    tokens = 0
+    async for _ in app.stream_openrouter({"messages": []}, {}):
+        tokens += 1
+    return tokens
+
+
+def run_after(url):
+    app.OPENROUTER_CHAT_URL = url
+    stats['peak'] = 0
+
+    async def main():
+        return await asyncio.gather(*(async_stream() for _ in range(STREAMS)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    return time.perf_counter() - started, stats['peak']
+
+
+if __name__ == '__main__':
+    url = start_fake_server()
+    ideal = CHUNKS * CHUNK_DELAY
+    print(f"{STREAMS} streams, ~{ideal:.1f}s each, {WORKER_THREADS} worker threads for the blocking path\n")
+    for label, runner in (("before (requests, threads)", run_before), ("after (httpx.AsyncClient)", run_after)):
+        elapsed, peak = runner(url)
+        print(f"{label:28} wall {elapsed:6.2f}s  peak concurrent streams {peak:4d}  "
+              f"throughput {STREAMS / elapsed:6.1f} streams/s")
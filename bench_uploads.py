@@ -0,0 +1,71 @@
+"""/upload_images latency for 1, 4 and 10 images at several resolutions.
+
+Each batch is posted through the Flask test client twice:
+
+  serial: image_executor with a single worker (one image at a time, as before)
+  pool:   image_executor sized to IMAGE_WORKERS (defaults to the core count)
+
+Usage: python bench_uploads.py [rounds]
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import app
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+RESOLUTIONS = [(1280, 960), (3024, 4032), (4000, 6000)]
+BATCHES = [1, 4, 10]
+
+
+def make_photo(size):
+    # Upscaled noise compresses like a real photo, unlike a flat colour
+    small = (size[0] // 8, size[1] // 8)
+    img = Image.frombytes('RGB', small, os.urandom(small[0] * small[1] * 3)).resize(size, Image.Resampling.BILINEAR)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=92)
+    return output.getvalue()
+
+
+def post_batch(client, photo, count):
+    files = [(io.BytesIO(photo), f'photo{i}.jpg') for i in range(count)]
+    started = time.perf_counter()
+    response = client.post('/upload_images', data={'images': files}, content_type='multipart/form-data')
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return elapsed
+
+
+def run(client, executor, photo, count):
+    app.image_executor = executor
+    best = float('inf')
+    for _ in range(ROUNDS):
+        # Fresh store so identical bytes aren't skipped as already stored
+        app.image_store = app.ImageStore(tempfile.mkdtemp(prefix='bench-image-store-'))
+        best = min(best, post_batch(client, photo, count))
+    return best * 1000
+
+
+if __name__ == '__main__':
+    client = app.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user'] = {'id': 'bench', 'name': 'Bench User'}
+
+    serial = ThreadPoolExecutor(max_workers=1)
+    pool = ThreadPoolExecutor(max_workers=app.IMAGE_WORKERS)
+    print(f"{app.IMAGE_WORKERS} image workers on {os.cpu_count()} cores, best of {ROUNDS}\n")
+    print(f"{'resolution':>12} {'images':>6} {'serial ms':>10} {'pool ms':>10} {'speedup':>8}")
+    for size in RESOLUTIONS:
+        photo = make_photo(size)
+        for count in BATCHES:
+            if len(photo) * count > app.app.config['MAX_CONTENT_LENGTH']:
+                print(f"{size[0]:>5}x{size[1]:<6} {count:>6}   skipped, over MAX_CONTENT_LENGTH")
+                continue
+            serial_ms = run(client, serial, photo, count)
+            pool_ms = run(client, pool, photo, count)
+            print(f"{size[0]:>5}x{size[1]:<6} {count:>6} {serial_ms:>10.0f} {pool_ms:>10.0f} {serial_ms / pool_ms:>7.2f}x")
@@ -50,6 +50,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const sendBtn = document.getElementById('send-btn');
     const stopBtn = document.getElementById('stop-btn');
     let controller = null;
+    let activeGenerationId = null;
+    const MAX_RESUME_ATTEMPTS = 5;
 
     const codeEditorPanel = document.getElementById('code-editor-panel');
     const codeEditorContent = document.getElementById('code-editor-content');
@@ -137,6 +139,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
     let forceWebSearch = false;
     let currentImages = []; // Array to store multiple images
+    // Saved messages the server should already have for this conversation (history is built server-side)
+    // Only the latest page is rendered, so the total comes from the server
+    let persistedMessageCount = parseInt(chatContainer?.dataset.messageCount, 10) || document.querySelectorAll('.message-block').length;
 
     // Web search toggle
     if (webSearchToggle) {
@@ -217,6 +222,10 @@ document.addEventListener('DOMContentLoaded', () => {
         validFiles.forEach(file => {
             formData.append('images', file);
         });
+        // Lets the server pick an image format the selected model accepts
+        if (window.getSelectedModel) {
+            formData.append('model', window.getSelectedModel());
+        }
 
         try {
             showImageProcessing(true);
@@ -263,31 +272,174 @@ document.addEventListener('DOMContentLoaded', () => {
         addButtonsToCodeBlocks(element);
     }
 
-    function parseAndRenderExistingMessages() {
-        document.querySelectorAll('.message-block:not(.self-end)').forEach(messageBlock => {
-            const contentEl = messageBlock.querySelector('.message-content');
-            if (!contentEl || !contentEl.dataset.raw) {
-                if (contentEl) {
-                    renderFormattedContent(contentEl, contentEl.textContent);
-                }
-                return;
+    function renderStoredMessage(messageBlock) {
+        const contentEl = messageBlock.querySelector('.message-content');
+        if (!contentEl || !contentEl.dataset.raw) {
+            if (contentEl) {
+                renderFormattedContent(contentEl, contentEl.textContent);
             }
+            return;
+        }
 
-            const rawText = contentEl.dataset.raw;
-            const thinkMatch = rawText.match(/<think>([\s\S]*?)<\/think>/s);
+        const rawText = contentEl.dataset.raw;
+        const thinkMatch = rawText.match(/<think>([\s\S]*?)<\/think>/s);
 
-            if (thinkMatch && thinkMatch[1]) {
-                const reasoningContent = thinkMatch[1].trim();
-                const displayContent = rawText.replace(/<think>[\s\S]*?<\/think>/s, '').trim();
+        if (thinkMatch && thinkMatch[1]) {
+            const reasoningContent = thinkMatch[1].trim();
+            const displayContent = rawText.replace(/<think>[\s\S]*?<\/think>/s, '').trim();
 
-                if (reasoningContent) {
-                    updateReasoning(messageBlock, reasoningContent);
-                }
-                renderFormattedContent(contentEl, displayContent);
-            } else {
-                renderFormattedContent(contentEl, rawText);
+            if (reasoningContent) {
+                updateReasoning(messageBlock, reasoningContent);
+            }
+            renderFormattedContent(contentEl, displayContent);
+        } else {
+            renderFormattedContent(contentEl, rawText);
+        }
+    }
+
+    function parseAndRenderExistingMessages() {
+        document.querySelectorAll('.message-block:not(.self-end)').forEach(renderStoredMessage);
+    }
+
+    // --- Lazy loading of older messages and reasoning ---
+    let beforeCursor = null;
+    try {
+        beforeCursor = JSON.parse(chatContainer?.dataset.beforeCursor || 'null');
+    } catch (e) {
+        beforeCursor = null;
+    }
+    let loadingOlderMessages = false;
+
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }
+
+    // Mirrors the server-rendered message markup in index.html
+    function buildStoredMessage(message) {
+        const isUser = message.sender === 'user';
+        const flexWrapper = document.createElement('div');
+        flexWrapper.className = `flex w-full mb-6 ${isUser ? 'justify-end' : 'justify-start'}`;
+        flexWrapper.dataset.timestamp = message.created_at;
+
+        const column = document.createElement('div');
+        column.className = `flex flex-col ${isUser ? 'items-end' : 'items-start'}`;
+        flexWrapper.appendChild(column);
+
+        if (!isUser && message.has_reasoning) {
+            const details = document.createElement('details');
+            details.className = 'reasoning-container w-full mt-2 mb-2 px-2 text-sm font-semibold';
+            details.dataset.reasoningId = message.id;
+            details.innerHTML = `
+                <summary class="inline-block text-white cursor-pointer hover:text-white py-2 px-3 rounded-xl">Show Thinking</summary>
+                <div class="reasoning-content pt-2 pl-4 border-l-2 border-gray-600 text-gray-400 prose prose-sm whitespace-pre-wrap"></div>
+            `;
+            column.appendChild(details);
+        }
+
+        const messageBlock = document.createElement('div');
+        messageBlock.className = 'message-block max-w-full';
+        messageBlock.dataset.messageId = message.id;
+        messageBlock.dataset.rawText = message.content || '';
+        column.appendChild(messageBlock);
+
+        if (isUser && message.image_urls && message.image_urls.length > 0) {
+            const imageContainer = document.createElement('div');
+            imageContainer.className = 'flex flex-wrap gap-2 mb-2 justify-end';
+            message.image_urls.forEach((src, i) => {
+                // Tiles show the thumbnail; the original opens on click
+                const link = document.createElement('a');
+                link.href = src;
+                link.target = '_blank';
+                link.rel = 'noopener noreferrer';
+                const img = document.createElement('img');
+                img.src = (message.thumbnail_urls && message.thumbnail_urls[i]) || src;
+                img.alt = 'Message image';
+                img.loading = 'lazy';
+                img.className = 'w-36 h-36 bg-transparent rounded-2xl object-cover';
+                link.appendChild(img);
+                imageContainer.appendChild(link);
+            });
+            messageBlock.appendChild(imageContainer);
+        }
+
+        if (message.content) {
+            const bubble = document.createElement('div');
+            bubble.className = `px-4 py-2 rounded-2xl break-words message-content ${
+                isUser ? 'bg-[#333537] text-white mt-2 max-w-lg ml-20' : 'text-gray-200 prose prose-invert'
+            }`;
+            bubble.dataset.raw = message.content;
+            if (isUser) {
+                bubble.innerHTML = escapeHtml(message.content).replace(/\n/g, '<br>');
             }
+            messageBlock.appendChild(bubble);
+        }
+
+        if (!isUser) {
+            appendSources(messageBlock, message.sources);
+        }
+        return { flexWrapper, messageBlock };
+    }
+
+    async function loadOlderMessages() {
+        const conversationId = chatContainer?.dataset.conversationId;
+        if (!beforeCursor || loadingOlderMessages || !conversationId) return;
+        loadingOlderMessages = true;
+        try {
+            const params = new URLSearchParams({ created_at: beforeCursor.created_at, id: beforeCursor.id });
+            const response = await fetch(`/conversation/${conversationId}/messages?${params}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const page = await response.json();
+
+            const innerChatContainer = document.querySelector('#chat-container > .w-full.max-w-3xl.mx-auto.flex.flex-col');
+            const fragment = document.createDocumentFragment();
+            const aiBlocks = [];
+            page.messages.forEach(message => {
+                const { flexWrapper, messageBlock } = buildStoredMessage(message);
+                fragment.appendChild(flexWrapper);
+                if (message.sender === 'ai') aiBlocks.push(messageBlock);
+            });
+
+            // Keep the viewport anchored on what the user was reading
+            const previousHeight = chatContainer.scrollHeight;
+            innerChatContainer.insertBefore(fragment, innerChatContainer.firstChild);
+            aiBlocks.forEach(renderStoredMessage);
+            chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+
+            beforeCursor = page.next_cursor;
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            loadingOlderMessages = false;
+        }
+    }
+
+    if (chatContainer) {
+        chatContainer.addEventListener('scroll', () => {
+            if (chatContainer.scrollTop < 200) loadOlderMessages();
         });
+
+        // 'toggle' doesn't bubble, so listen in the capture phase
+        chatContainer.addEventListener('toggle', async (e) => {
+            const details = e.target;
+            if (!details.matches?.('details.reasoning-container[data-reasoning-id]') || !details.open) return;
+            if (details.dataset.reasoningLoaded) return;
+            details.dataset.reasoningLoaded = 'true';
+
+            const contentDiv = details.querySelector('.reasoning-content');
+            contentDiv.innerText = 'Loading...';
+            try {
+                const response = await fetch(`/messages/${details.dataset.reasoningId}/reasoning`);
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                const data = await response.json();
+                contentDiv.innerText = data.reasoning;
+            } catch (error) {
+                console.error('Error loading reasoning:', error);
+                contentDiv.innerText = 'Failed to load reasoning.';
+                delete details.dataset.reasoningLoaded;
+            }
+        }, true);
     }
 
     function getCodeLanguage(codeElement) {
@@ -585,7 +737,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!imagePreview || currentImages.length === 0) return;
         const imagesHtml = currentImages.map((img, index) => `
             <div class="relative group">
-                <img src="data:${img.mime_type};base64,${img.image_data}" alt="${img.filename}" class="w-20 h-20 object-cover rounded-lg">
+                <img src="${img.url}" alt="${img.filename}" class="w-20 h-20 object-cover rounded-lg">
                 <button onclick="removeImage(${index})" class="absolute -top-2 -right-2 w-6 h-6 bg-slate-500 hover:bg-slate-600 text-white rounded-full flex items-center justify-center text-xs opacity-0 group-hover:opacity-100 transition-opacity">
                     ×
                 </button>
@@ -744,7 +896,6 @@ document.addEventListener('DOMContentLoaded', () => {
         appendMessage(message, 'user', currentImages);
         const imagesToSend = [...currentImages];
         clearImagesPreview();
-        const history = getHistoryFromDOM();
         let conversationId = window.location.pathname.split('/').pop();
         if (!/^[0-9a-fA-F-]{36}$/.test(conversationId)) {
             conversationId = null;
@@ -753,14 +904,18 @@ document.addEventListener('DOMContentLoaded', () => {
         try {
             const requestPayload = {
                 message: message,
-                history: history,
                 conversation_id: conversationId,
+                message_count: persistedMessageCount,
                 model: window.getSelectedModel ? window.getSelectedModel() : "z-ai/glm-4.5-air:free",
                 force_web_search: forceWebSearch,
                 force_thinking: forceThinking, // Add this line
             };
             if (imagesToSend.length > 0) {
-                requestPayload.images_data = imagesToSend;
+                // The server already has the bytes; send only the handles
+                requestPayload.images_data = imagesToSend.map(img => ({
+                    handle: img.handle,
+                    filename: img.filename
+                }));
             }
 
             const response = await fetch('/chat', {
@@ -774,21 +929,49 @@ document.addEventListener('DOMContentLoaded', () => {
 
             const aiMessageElement = appendMessage("", 'ai');
             const aiContentElement = aiMessageElement.querySelector('.message-content');
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
+            activeGenerationId = response.headers.get('X-Generation-Id');
+            let reader = response.body.getReader();
+            let decoder = new TextDecoder();
             let buffer = "";
             let combinedReasoningSSE = "";
             let fullAiResponseText = "";
+            let lastEventId = null;
+            let streamFinished = false;
+            let resumedFrom;
+            let stalledResumes = 0;
 
             while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
+                let chunk;
+                try {
+                    chunk = await reader.read();
+                } catch (readError) {
+                    if (readError.name === 'AbortError' || !activeGenerationId) throw readError;
+                    chunk = { done: true };
+                }
+                if (chunk.done) {
+                    if (streamFinished || !activeGenerationId) break;
+                    // Resumes that bring no new frames won't recover the answer; stop instead of looping
+                    stalledResumes = lastEventId === resumedFrom ? stalledResumes + 1 : 0;
+                    if (stalledResumes >= MAX_RESUME_ATTEMPTS) throw new Error('The connection was lost');
+                    resumedFrom = lastEventId;
+                    // The connection dropped mid-answer; the server kept generating, so
+                    // pick up after the last frame we saw instead of starting over
+                    reader = await resumeStream(activeGenerationId, lastEventId, controller.signal);
+                    decoder = new TextDecoder();
+                    buffer = "";
+                    continue;
+                }
 
-                buffer += decoder.decode(value, { stream: true });
+                buffer += decoder.decode(chunk.value, { stream: true });
                 const events = buffer.split('\n\n');
                 buffer = events.pop();
 
-                for (const event of events) {
+                for (let event of events) {
+                    if (event.startsWith('id: ')) {
+                        const lineEnd = event.indexOf('\n');
+                        lastEventId = event.substring(4, lineEnd);
+                        event = event.substring(lineEnd + 1);
+                    }
                     if (event.startsWith('event: new_conversation')) {
                         const data = JSON.parse(event.split('\n')[1].substring(6));
                         window.history.replaceState({}, '', `/conversation/${data.id}`);
@@ -796,6 +979,9 @@ document.addEventListener('DOMContentLoaded', () => {
                     } else if (event.startsWith('event: sources')) {
                         const data = JSON.parse(event.split('\n')[1].substring(6));
                         appendSources(aiMessageElement, data);
+                    } else if (event.startsWith('event: saved')) {
+                        // Only a completed answer is stored; error replies don't count
+                        persistedMessageCount = JSON.parse(event.split('\n')[1].substring(6)).message_count;
                     } else if (event.startsWith('event: reasoning')) {
                         const data = JSON.parse(event.split('\n')[1].substring(6));
                         combinedReasoningSSE = combinedReasoningSSE ? `${combinedReasoningSSE}${data}` : data;  // Changed += to direct concatenation
@@ -803,6 +989,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     } else if (event.startsWith('data: ')) {
                         const data = event.substring(6);
                         if (data === '[DONE]') {
+                            streamFinished = true;
                             reader.cancel();
                             break;
                         }
@@ -855,6 +1042,7 @@ document.addEventListener('DOMContentLoaded', () => {
             sendBtn.classList.remove('hidden');
             stopBtn.classList.add('hidden');
             controller = null;
+            activeGenerationId = null;
             messageInput.focus();
         }
     });
@@ -862,9 +1050,35 @@ document.addEventListener('DOMContentLoaded', () => {
     stopBtn.addEventListener('click', () => {
         if (controller) {
             controller.abort();
+            // Generations run on the server independently of this connection
+            if (activeGenerationId) {
+                fetch(`/chat/${activeGenerationId}/cancel`, { method: 'POST' }).catch(() => {});
+            }
         }
     });
 
+    // Reconnects to a running generation and replays the frames after lastEventId
+    async function resumeStream(generationId, lastEventId, signal) {
+        for (let attempt = 1; ; attempt++) {
+            await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+            let response;
+            try {
+                response = await fetch(`/chat/${generationId}/events`, {
+                    headers: { 'Last-Event-ID': lastEventId ?? '-1' },
+                    signal
+                });
+            } catch (error) {
+                // Still offline: retry a few times, but never past a user abort
+                if (error.name === 'AbortError' || attempt >= MAX_RESUME_ATTEMPTS) throw error;
+                continue;
+            }
+            if (!response.ok) {
+                throw new Error((await response.json()).error || 'The connection was lost');
+            }
+            return response.body.getReader();
+        }
+    }
+
     function appendMessage(content, sender, images = [], isError = false) {
         const emptyState = document.getElementById('empty-state');
         if (emptyState) emptyState.remove();
@@ -882,7 +1096,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const imageContainer = document.createElement('div');
             imageContainer.className = 'flex flex-wrap gap-2 mb-2 justify-end';
             imageContainer.innerHTML = images.map(img =>
-                `<img src="data:${img.mime_type};base64,${img.image_data}" alt="Uploaded image" class="w-36 h-36 bg-transparent rounded-2xl object-cover">`
+                `<img src="${img.url}" alt="Uploaded image" class="w-36 h-36 bg-transparent rounded-2xl object-cover">`
             ).join('');
             messageBlock.appendChild(imageContainer);
         }
@@ -979,28 +1193,6 @@ document.addEventListener('DOMContentLoaded', () => {
     }
  
     
-    function getHistoryFromDOM() {
-        const history = [];
-        document.querySelectorAll('.message-block').forEach(block => {
-            const role = block.classList.contains('self-end') ? 'user' : 'assistant';
-            const contentEl = block.querySelector('.message-content');
-            if (contentEl) {
-                const imgEls = block.querySelectorAll('img'); // Look in the whole block
-                let content = contentEl.innerText;
-                if (imgEls.length > 0 && role === 'user') {
-                    const multimodalContent = [{ type: "text", text: content }];
-                    // This part seems incorrect as it re-adds images from history. 
-                    // Sticking to text for now as images are sent in the payload.
-                    // This function might need revision based on exact use case.
-                    history.push({ role: role, content: content });
-                } else {
-                    history.push({ role: role, content: content });
-                }
-            }
-        });
-        return history.slice(0, -1); // Exclude the message we just added
-    }
-
     function addConversationToSidebar(id, title) {
         const sidebarNav = document.querySelector('#sidebar nav');
         if (!sidebarNav) {
@@ -1158,11 +1350,13 @@ document.addEventListener("DOMContentLoaded", () => {
 
     console.log('=== END DROPDOWN DEBUG ===');
 
-    document.querySelectorAll('#sidebar nav a').forEach(link => {
-        link.addEventListener('click', () => {
-            if (window.innerWidth < 768) {
+    // Delegated, so links lazily appended to the sidebar are covered too
+    const sidebarNav = document.querySelector('#sidebar nav');
+    if (sidebarNav) {
+        sidebarNav.addEventListener('click', (e) => {
+            if (e.target.closest('a') && window.innerWidth < 768) {
                 document.body.classList.add("sidebar-collapsed");
             }
         });
-    });
+    }
 });
\ No newline at end of file
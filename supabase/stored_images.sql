@@ -0,0 +1,44 @@
+-- Content-addressed chat images: one storage object per distinct image, shared by
+-- every message that references it. ref_count is the number of message references;
+-- objects whose row reaches 0 (or that have no row at all) are safe to delete.
+create table if not exists stored_images (
+    hash text primary key,
+    path text not null,
+    mime_type text not null,
+    size integer not null,
+    thumbnail_path text,
+    ref_count integer not null default 0,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+alter table stored_images add column if not exists thumbnail_path text;
+
+-- Takes one reference, creating the row on first use. Returns the new count.
+drop function if exists acquire_stored_image(text, text, text, integer);
+create or replace function acquire_stored_image(
+    p_hash text, p_path text, p_mime_type text, p_size integer, p_thumbnail_path text default null
+)
+returns integer
+language sql
+as $$
+    insert into stored_images (hash, path, mime_type, size, thumbnail_path, ref_count)
+    values (p_hash, p_path, p_mime_type, p_size, p_thumbnail_path, 1)
+    on conflict (hash) do update
+        set ref_count = stored_images.ref_count + 1,
+            thumbnail_path = coalesce(excluded.thumbnail_path, stored_images.thumbnail_path),
+            updated_at = now()
+    returning ref_count;
+$$;
+
+-- Drops one reference when a message is deleted. Returns the remaining count.
+create or replace function release_stored_image(p_hash text)
+returns integer
+language sql
+as $$
+    update stored_images
+        set ref_count = greatest(ref_count - 1, 0),
+            updated_at = now()
+        where hash = p_hash
+    returning ref_count;
+$$;